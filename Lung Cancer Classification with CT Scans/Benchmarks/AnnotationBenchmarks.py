@@ -0,0 +1,291 @@
+import numpy as np
+import matplotlib.path as mplpath
+from time import (perf_counter)
+from scipy.spatial.distance import (pdist, squareform)
+import customPylidc as pl
+from customPylidc import (geometry, surface_area, resample)
+from skimage.measure import (marching_cubes, mesh_surface_area)
+
+def _legacyBooleanMask(annotation:pl.Annotation, pad=None, bbox:np.ndarray=None, include_contour_points:bool=False) -> np.ndarray:
+    """
+    # Description
+        -> Previous implementation of Annotation.boolean_mask, which tests every pixel
+        of the bounding box against each contour with matplotlib (kept for comparison purposes).
+    --------------------------------------------------------------------------------------------
+    := param: annotation - Annotation whose mask is computed.
+    := param: pad - See Annotation.bbox.
+    := param: bbox - See Annotation.boolean_mask.
+    := param: include_contour_points - Whether or not the points of the inclusion contours are kept in the mask.
+    := return: Boolean volume covering the bounding box of the annotation.
+    """
+    bb = annotation.bbox_matrix(pad=pad) if bbox is None else bbox
+
+    # Map the z-value of each contour to its index in the volume
+    z_to_index = dict(zip(annotation.contour_slice_zvals, annotation.contour_slice_indices))
+
+    # Get dimensions, initialize mask
+    ni,nj,nk = np.diff(bb, axis=1).astype(int)[:,0] + 1
+    mask = np.zeros((ni,nj,nk), dtype=bool)
+
+    # Image coordinates of the pixels of a slice, offset by the bounding box
+    ii,jj = np.indices(mask.shape[:2])
+    test_points = bb[:2,0] + np.c_[ii.flatten(), jj.flatten()]
+
+    # Turn on the pixels enclosed by inclusion contours, then turn off the ones enclosed by exclusion contours
+    for inclusion in [True, False]:
+        for contour in annotation.contours:
+            if contour.inclusion != inclusion:
+                continue
+
+            zi = z_to_index[contour.image_z_position] - bb[2,0]
+            C = contour.to_matrix(include_k=False)
+
+            # Turn the contour closed if it is not
+            if (C[0] != C[-1]).any():
+                C = np.append(C, C[0].reshape(1,2), axis=0)
+
+            contains_pts = mplpath.Path(C, closed=True).contains_points(test_points).reshape(mask.shape[:2])
+            if inclusion:
+                mask[:,:,zi] = np.logical_or(mask[:,:,zi], contains_pts)
+            else:
+                mask[:,:,zi] = np.logical_and(mask[:,:,zi], ~contains_pts)
+
+            # Remove the contour points themselves
+            if not (inclusion and include_contour_points):
+                i, j = (C - bb[:2,0]).T
+                mask[i,j,np.ones(C.shape[0], dtype=int)*zi] = False
+
+    return mask
+
+def checkBooleanMaskRegression(annotations:list=None, verbose:bool=True) -> int:
+    """
+    # Description
+        -> Checks that Annotation.boolean_mask matches the previous implementation bit
+        for bit (with and without the contour points) over the annotations of the pylidc database.
+    ----------------------------------------------------------------------------------------------
+    := param: annotations - Annotations to check (defaults to all the annotations of the database).
+    := param: verbose - Whether or not to print the results.
+    := return: Number of annotations checked.
+    """
+    annotations = pl.query(pl.Annotation).all() if annotations is None else annotations
+
+    for annotation in annotations:
+        for includeContourPoints in [False, True]:
+            mask = annotation.boolean_mask(include_contour_points=includeContourPoints)
+            legacyMask = _legacyBooleanMask(annotation, include_contour_points=includeContourPoints)
+            if mask.shape != legacyMask.shape or (mask != legacyMask).any():
+                raise AssertionError(f'The mask of the annotation {annotation.id} differs from the previous implementation!')
+
+    if verbose:
+        print(f"[{len(annotations)} annotations] Boolean masks match the previous implementation")
+
+    return len(annotations)
+
+def benchmarkBooleanMask(numberAnnotations:int=200, repeats:int=3, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the scanline rasterization used by Annotation.boolean_mask against the previous
+        matplotlib implementation on the first annotations of the pylidc database.
+    -----------------------------------------------------------------------------------------------
+    := param: numberAnnotations - Number of annotations whose masks are computed.
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary with the best time (in seconds) of each implementation and the obtained speedup.
+    """
+    annotations = pl.query(pl.Annotation).limit(numberAnnotations).all()
+
+    # Load the contours beforehand so that only the mask computation is timed
+    for annotation in annotations:
+        annotation.contours
+
+    legacyTimes, vectorizedTimes = [], []
+    for _ in range(repeats):
+        start = perf_counter()
+        for annotation in annotations:
+            _legacyBooleanMask(annotation)
+        legacyTimes.append(perf_counter() - start)
+
+        # The geometry cache is cleared so that the contour parsing and filling are timed as well
+        geometry.clear_cache()
+        start = perf_counter()
+        for annotation in annotations:
+            annotation.boolean_mask()
+        vectorizedTimes.append(perf_counter() - start)
+
+    results = {
+        'legacy':min(legacyTimes),
+        'vectorized':min(vectorizedTimes),
+        'speedup':min(legacyTimes) / min(vectorizedTimes)
+    }
+
+    if verbose:
+        print(f"[{len(annotations)} annotations] Legacy: {results['legacy']:.4f}s | Vectorized: {results['vectorized']:.4f}s | Speedup: {results['speedup']:.1f}x")
+
+    return results
+
+def _legacyDiameter(annotation:pl.Annotation) -> float:
+    """
+    # Description
+        -> Previous implementation of Annotation.diameter, which computes the matrix
+        of pairwise distances between the points of each contour (kept for comparison purposes).
+    --------------------------------------------------------------------------------------------
+    := param: annotation - Annotation whose diameter is computed.
+    := return: Maximal axial plane diameter of the annotation (in mm).
+    """
+    greatestDiameter = -np.inf
+    for contour in annotation.contours:
+        contourArray = contour.to_matrix()[:,:2]*annotation.scan.pixel_spacing
+
+        # Contours consisting of a single point are ignored
+        if contourArray.shape[0] == 1:
+            continue
+
+        greatestDiameter = max(greatestDiameter, squareform(pdist(contourArray)).max())
+
+    return greatestDiameter
+
+def benchmarkAnnotationDiameters(numberAnnotations:int=1000, repeats:int=3, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the batched rotating calipers diameters (geometry.annotation_diameters) against
+        the previous pairwise distance matrices on the first annotations of the pylidc database,
+        checking that both agree to 1e-9 mm.
+    -----------------------------------------------------------------------------------------------
+    := param: numberAnnotations - Number of annotations whose diameters are computed.
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary with the best time (in seconds) of each implementation and the obtained speedup.
+    """
+    annotations = pl.query(pl.Annotation).limit(numberAnnotations).all()
+
+    # Load the contours and scans beforehand so that only the diameter computation is timed
+    for annotation in annotations:
+        annotation.contours, annotation.scan.pixel_spacing
+        geometry.annotation_geometry(annotation)
+
+    legacyTimes, batchedTimes = [], []
+    for _ in range(repeats):
+        start = perf_counter()
+        legacyDiameters = [_legacyDiameter(annotation) for annotation in annotations]
+        legacyTimes.append(perf_counter() - start)
+
+        # Drop the cached diameters so that they are computed again
+        for annotation in annotations:
+            geometry.annotation_geometry(annotation)._diameters = None
+        start = perf_counter()
+        batchedDiameters = geometry.annotation_diameters(annotations)
+        batchedTimes.append(perf_counter() - start)
+
+    if not np.allclose(legacyDiameters, batchedDiameters, rtol=0, atol=1e-9):
+        raise AssertionError('The diameters differ from the previous implementation!')
+
+    results = {
+        'legacy':min(legacyTimes),
+        'batched':min(batchedTimes),
+        'speedup':min(legacyTimes) / min(batchedTimes)
+    }
+
+    if verbose:
+        print(f"[{len(annotations)} annotations] Legacy: {results['legacy']:.4f}s | Batched: {results['batched']:.4f}s | Speedup: {results['speedup']:.1f}x")
+
+    return results
+
+def _legacySurfaceArea(annotation:pl.Annotation) -> float:
+    """
+    # Description
+        -> Previous implementation of Annotation.surface_area, which runs marching
+        cubes over a float64 copy of the padded mask (kept for comparison purposes).
+    --------------------------------------------------------------------------------
+    := param: annotation - Annotation whose surface area is computed.
+    := return: Estimated surface area of the annotation (in mm^2).
+    """
+    mask = np.pad(annotation.boolean_mask(), [(1,1), (1,1), (1,1)], 'constant').astype(float)
+    rij = annotation.scan.pixel_spacing
+    rk = annotation.scan.slice_thickness
+    verts, faces, _, _ = marching_cubes(mask, 0.5, spacing=(rij, rij, rk))
+    return mesh_surface_area(verts, faces)
+
+def benchmarkSurfaceArea(numberAnnotations:int=500, numWorkers:int=None, repeats:int=3, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the speed and accuracy of the surface area engine (marching cubes on the
+        boolean masks over a thread pool, and voxel face counting) against the previous
+        Annotation.surface_area on the first annotations of the pylidc database.
+    -----------------------------------------------------------------------------------------
+    := param: numberAnnotations - Number of annotations whose surface areas are computed.
+    := param: numWorkers - Number of threads used by the engine.
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary with the best time (in seconds) and the maximum relative error of each implementation.
+    """
+    annotations = pl.query(pl.Annotation).limit(numberAnnotations).all()
+
+    # Load the contours and scans beforehand so that only the surface area computation is timed
+    for annotation in annotations:
+        annotation.contours, annotation.scan.pixel_spacing
+        annotation.boolean_mask()
+
+    times = {'legacy':[], 'marching_cubes':[], 'faces':[]}
+    for _ in range(repeats):
+        start = perf_counter()
+        legacyAreas = np.array([_legacySurfaceArea(annotation) for annotation in annotations])
+        times['legacy'].append(perf_counter() - start)
+
+        areas = {}
+        for method in ['marching_cubes', 'faces']:
+            start = perf_counter()
+            areas[method] = surface_area.annotation_surface_areas(annotations, method=method, n_workers=numWorkers)
+            times[method].append(perf_counter() - start)
+
+    results = {}
+    for method in times:
+        values = legacyAreas if method == 'legacy' else areas[method]
+        results[method] = {'time':min(times[method]), 'max_relative_error':np.max(np.abs(values - legacyAreas) / legacyAreas)}
+
+    if verbose:
+        for method, result in results.items():
+            print(f"[{len(annotations)} annotations | {method}] Time: {result['time']:.4f}s | Speedup: {results['legacy']['time'] / result['time']:.1f}x | Max relative error: {result['max_relative_error']:.2e}")
+
+    return results
+
+def benchmarkResampling(scan:pl.Scan, repeats:int=3, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the batch resampler (resample.resample_annotations) against calling
+        Annotation.uniform_cubic_resample for each annotation of a scan, checking that
+        both produce the same masks. The DICOM files of the scan must be available.
+    -------------------------------------------------------------------------------------
+    := param: scan - Scan whose annotations are resampled.
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary with the best time (in seconds) of each implementation and the obtained speedup.
+    """
+    annotations = scan.annotations
+    sideLength = int(np.ceil(max(annotation.bbox_dims().max() for annotation in annotations)))
+
+    # Build the volume cache beforehand so that only the resampling is timed
+    scan.to_volume(verbose=False, mmap=True)
+
+    legacyTimes, batchTimes = [], []
+    for _ in range(repeats):
+        start = perf_counter()
+        legacyMasks = [annotation.uniform_cubic_resample(sideLength, verbose=False)[1] for annotation in annotations]
+        legacyTimes.append(perf_counter() - start)
+
+        start = perf_counter()
+        _, batchMasks = resample.resample_annotations(annotations, sideLength, verbose=False)
+        batchTimes.append(perf_counter() - start)
+
+    if not all((legacyMask == batchMask).all() for legacyMask, batchMask in zip(legacyMasks, batchMasks)):
+        raise AssertionError('The resampled masks differ from the previous implementation!')
+
+    results = {
+        'legacy':min(legacyTimes),
+        'batch':min(batchTimes),
+        'speedup':min(legacyTimes) / min(batchTimes)
+    }
+
+    if verbose:
+        print(f"[{len(annotations)} annotations] Legacy: {results['legacy']:.4f}s | Batch: {results['batch']:.4f}s | Speedup: {results['speedup']:.1f}x")
+
+    return results
@@ -0,0 +1,94 @@
+import numpy as np
+from time import (perf_counter)
+from customPylidc.Scan import (_unique_slice_order)
+
+def _legacyDuplicateSlicePruning(zs:list, inums:list) -> list:
+    """
+    # Description
+        -> Previous implementation of the duplicate z slices pruning performed
+        inside Scan.load_all_dicom_images (kept for comparison purposes).
+    --------------------------------------------------------------------------
+    := param: zs - List with the z coordinate of each slice.
+    := param: inums - List with the instance number of each slice.
+    := return: List with the indices of the kept slices sorted by z.
+    """
+    inds = list(range(len(zs)))
+    while np.unique(zs).shape[0] != len(inds):
+        for i in inds:
+            for j in inds:
+                if i!=j and zs[i] == zs[j]:
+                    k = i if inums[i] > inums[j] else j
+                    inds.pop(inds.index(k))
+
+    # Prune the duplicates and sort the kept slices by z
+    keptIndices = [i for i in range(len(zs)) if i in inds]
+    keptZs = [zs[i] for i in keptIndices]
+    return [keptIndices[s] for s in np.argsort(keptZs)]
+
+def createSyntheticSeries(numberSlices:int=1000, duplicateFraction:float=0.1, seed:int=0) -> tuple:
+    """
+    # Description
+        -> Creates the z coordinates and instance numbers of a synthetic
+        (shuffled) DICOM series in which some of the slices share the same z.
+    -------------------------------------------------------------------------
+    := param: numberSlices - Number of slices of the series.
+    := param: duplicateFraction - Fraction of the slices that duplicate the z of another slice.
+    := param: seed - Seed used to generate the series.
+    := return: Tuple with the lists of z coordinates and instance numbers.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Create a uniformly spaced series and duplicate some of its z values
+    # [Each z value is repeated at most once since the previous implementation fails when a z value appears 3 or more times]
+    numberDuplicates = int(numberSlices*duplicateFraction)
+    zs = -0.625*np.arange(numberSlices - numberDuplicates)
+    zs = np.r_[zs, rng.choice(zs, numberDuplicates, replace=False)]
+
+    # Each slice has a unique instance number (as within a DICOM series)
+    inums = (rng.permutation(numberSlices) + 1).astype(float)
+
+    # Shuffle the slices (as listed by os.listdir)
+    order = rng.permutation(numberSlices)
+    return zs[order].tolist(), inums[order].tolist()
+
+def benchmarkDuplicateSlicePruning(numberSlices:int=1000, duplicateFraction:float=0.1, repeats:int=3, seed:int=0, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the vectorized duplicate z slices pruning used by
+        Scan.load_all_dicom_images against the previous nested loop
+        on a synthetic series, checking that both keep the same slices.
+    -------------------------------------------------------------------
+    := param: numberSlices - Number of slices of the synthetic series.
+    := param: duplicateFraction - Fraction of the slices that duplicate the z of another slice.
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: seed - Seed used to generate the series.
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary with the best time (in seconds) of each implementation and the obtained speedup.
+    """
+    zs, inums = createSyntheticSeries(numberSlices, duplicateFraction, seed)
+
+    # Time both implementations
+    legacyTimes, vectorizedTimes = [], []
+    for _ in range(repeats):
+        start = perf_counter()
+        legacyIndices = _legacyDuplicateSlicePruning(zs, inums)
+        legacyTimes.append(perf_counter() - start)
+
+        start = perf_counter()
+        vectorizedIndices = _unique_slice_order(zs, inums)
+        vectorizedTimes.append(perf_counter() - start)
+
+    # Both implementations must keep the same slices in the same order
+    if list(vectorizedIndices) != legacyIndices:
+        raise AssertionError('The vectorized pruning did not keep the same slices as the previous implementation!')
+
+    results = {
+        'legacy':min(legacyTimes),
+        'vectorized':min(vectorizedTimes),
+        'speedup':min(legacyTimes) / min(vectorizedTimes)
+    }
+
+    if verbose:
+        print(f"[{numberSlices} slices, {len(zs) - len(legacyIndices)} duplicates] Legacy: {results['legacy']:.4f}s | Vectorized: {results['vectorized']:.6f}s | Speedup: {results['speedup']:.1f}x")
+
+    return results
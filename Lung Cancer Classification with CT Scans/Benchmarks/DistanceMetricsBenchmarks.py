@@ -0,0 +1,104 @@
+import numpy as np
+from time import (perf_counter)
+from scipy.spatial.distance import (cdist)
+import customPylidc as pl
+from customPylidc import (annotation_distance_metrics)
+
+def _legacyDistance(points1:np.ndarray, points2:np.ndarray, metric:str) -> float:
+    """
+    # Description
+        -> Previous implementation of the 'min', 'max', 'avg' and 'hausdorff' annotation
+        distance metrics, which computes the full distance matrix (kept for comparison purposes).
+    ---------------------------------------------------------------------------------------------
+    := param: points1 - Contour boundary points of the first annotation.
+    := param: points2 - Contour boundary points of the second annotation.
+    := param: metric - Name of the metric.
+    := return: Distance between the annotations.
+    """
+    C = cdist(points1, points2)
+    if metric == 'min':
+        return C.min()
+    elif metric == 'max':
+        return C.max()
+    elif metric == 'avg':
+        return C.mean()
+    return max(C.min(0).max(), C.min(1).max())
+
+def selectAnnotationPairs(sizeBins:list, pairsPerBin:int=20) -> list:
+    """
+    # Description
+        -> Selects pairs of annotations of the same scan from the pylidc database, grouped
+        by the number of contour points of the smallest annotation of each pair.
+    --------------------------------------------------------------------------------------
+    := param: sizeBins - List of (lower, upper) bounds on the number of contour points.
+    := param: pairsPerBin - Maximum number of pairs selected for each bin.
+    := return: List with the list of annotation pairs of each bin.
+    """
+    pairs = [[] for _ in sizeBins]
+    for scan in pl.query(pl.Scan).order_by(pl.Scan.id):
+        annotations = scan.annotations
+        for i in range(len(annotations)):
+            for j in range(i + 1, len(annotations)):
+                size = min(len(annotation_distance_metrics.annotation_points(a)) for a in [annotations[i], annotations[j]])
+                for b, (lower, upper) in enumerate(sizeBins):
+                    if lower <= size < upper and len(pairs[b]) < pairsPerBin:
+                        pairs[b].append((annotations[i], annotations[j]))
+
+        # Stop as soon as every bin is full
+        if all(len(binPairs) == pairsPerBin for binPairs in pairs):
+            break
+
+    return pairs
+
+def benchmarkDistanceMetrics(sizeBins:list=[(0, 100), (100, 500), (500, 2000), (2000, np.inf)], pairsPerBin:int=20, metrics:list=['min', 'max', 'avg', 'hausdorff'], repeats:int=3, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the KD-tree, convex hull and early break implementations of the annotation
+        distance metrics against the previous dense distance matrix across annotation sizes.
+        The caches of the metrics are cleared before each run, so building the trees and hulls is timed as well.
+    -------------------------------------------------------------------------------------------------------------
+    := param: sizeBins - List of (lower, upper) bounds on the number of contour points of the annotations.
+    := param: pairsPerBin - Maximum number of annotation pairs for each bin.
+    := param: metrics - Metrics to benchmark.
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary mapping each (metric, bin) to the best time (in seconds) of each implementation and the obtained speedup.
+    """
+    pairs = selectAnnotationPairs(sizeBins, pairsPerBin)
+
+    results = {}
+    for metric in metrics:
+        for (lower, upper), binPairs in zip(sizeBins, pairs):
+            if len(binPairs) == 0:
+                continue
+
+            legacyTimes, treeTimes = [], []
+            for _ in range(repeats):
+                # Only the contour points are kept between runs
+                points = [(annotation_distance_metrics.annotation_points(a), annotation_distance_metrics.annotation_points(b)) for a, b in binPairs]
+
+                start = perf_counter()
+                legacy = [_legacyDistance(p1, p2, metric) for p1, p2 in points]
+                legacyTimes.append(perf_counter() - start)
+
+                for annotation in {annotation for pair in binPairs for annotation in pair}:
+                    annotation.geometry.derived.clear()
+                start = perf_counter()
+                tree = [annotation_distance_metrics.metrics[metric](a, b) for a, b in binPairs]
+                treeTimes.append(perf_counter() - start)
+
+            # Both implementations must agree [The blocked 'avg' may only differ by rounding]
+            if not np.allclose(legacy, tree, rtol=1e-12, atol=0):
+                raise AssertionError(f'The {metric} distances differ from the previous implementation!')
+
+            results[(metric, (lower, upper))] = {
+                'legacy':min(legacyTimes),
+                'tree':min(treeTimes),
+                'speedup':min(legacyTimes) / min(treeTimes)
+            }
+
+            if verbose:
+                r = results[(metric, (lower, upper))]
+                print(f"[{metric} | {lower}-{upper} points | {len(binPairs)} pairs] Legacy: {r['legacy']:.4f}s | Tree: {r['tree']:.4f}s | Speedup: {r['speedup']:.1f}x")
+
+    return results
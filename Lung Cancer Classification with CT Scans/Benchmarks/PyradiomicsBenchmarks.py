@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+import statistics as stats
+from time import (perf_counter)
+import customPylidc as pl
+from DataPreProcessing.PyradiomicsDataPreProcessing import (refactorPyradiomicsDataset)
+
+def _legacyRefactorPyradiomicsDataset(df_pyradiomics:pd.DataFrame, pyradiomicsRefactoredFeaturesFilename:str, verbose:bool=False) -> pd.DataFrame:
+    """
+    # Description
+        -> Previous implementation of refactorPyradiomicsDataset, which filters the rows of each
+        patient with a regex over the whole id column and appends the nodules one at a time (kept for comparison purposes).
+    ------------------------------------------------------------------------------------------------------------------------
+    := param: df_pyradiomics - Extracted dataframe with the raw information.
+    := param: pyradiomicsRefactoredFeaturesFilename - Path to save the refactored version of the dataset.
+    := param: verbose - Boolean that enables valuable information during the function execution.
+    := return: Pandas dataframe with a refactored version of the pyradiomics dataframe.
+    """
+    # Define the columns for the refactored pyradiomics dataset
+    cols = ['nodule_id'] + list(df_pyradiomics.columns)
+
+    # Create a new empty dataframe for the refactored dataset
+    df = pd.DataFrame(columns=cols)
+
+    # Fetch all the Patient Ids Available
+    patientIds = sorted(np.unique([scan.patient_id for scan in pl.query(pl.Scan).all()]))
+
+    # Iterate over all the patient Ids
+    for patientId in patientIds:
+        if verbose:
+            print(f"\n-> [NEW PATIENT: {patientId}]\n")
+        
+        # Fetch the patient's scan
+        patientScan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patientId).first()
+
+        # Creating a mask to filter the current patient data from the pyradiomics dataframe
+        mask = df_pyradiomics[df_pyradiomics.columns[0]].str.contains(patientId)
+        
+        # Get the segment of the dataframe with the current patient
+        pyradiomicsPatientDf = df_pyradiomics.loc[mask]
+
+        if pyradiomicsPatientDf.shape[0] == 0:
+            print(f"Patient {patientId} not found inside the Pyradiomics extracted dataset!")
+            continue
+        
+        if verbose:
+            print(f"Patient dataframe shape: {pyradiomicsPatientDf.shape}")
+        
+        # Get the Patient Nodules Annotations
+        patientNodules = patientScan.cluster_annotations()
+
+        if verbose:
+            print(f"Number of nodules: {len(patientNodules)}")
+        
+        # Iterate over the patient nodules
+        for noduleId, nodule in enumerate(patientNodules):
+            if verbose:
+                print(f"[NEW NODULE: {noduleId + 1}]")
+                print(f"Number of annotations: {len(nodule)}")
+            
+            # Check that the nodule list is not empty
+            if len(nodule) == 0:
+                print(f"Skipping empty nodule: {noduleId}")
+                continue
+            
+            # Define a dictionary with the important features as keys and list with the current nodule
+            allAttributes = dict([(col, []) for col in df.columns[1:]])
+        
+            # Initialize a dictionary with the df's attributes / columns and empty strings
+            attributes = dict((col, "") for col in df.columns)
+            
+            # Iterate over the nodule annotations and save the important attributes inside the allAttributes dictionary
+            for currentAnnotation in range(len(nodule)):
+                if verbose:
+                    print(f"[NEW ANNOTATION: {currentAnnotation + 1}]")
+                
+                # Check if the number of annotations matches
+                if currentAnnotation >= pyradiomicsPatientDf.shape[0]:
+                    print(f"Skipping invalid annotation at index {currentAnnotation}")
+                    continue
+                
+                for noduleAttribute in df.columns[1:]:
+                    try:
+                        allAttributes[noduleAttribute] += [pyradiomicsPatientDf[noduleAttribute].values[currentAnnotation]]
+                    except KeyError:
+                        print(f"Skipping unknown attribute: {noduleAttribute}")
+                        continue
+
+            # Add an ID for the patient nodule
+            attributes['nodule_id'] = f"{patientId}-{noduleId + 1}"
+            
+            # Normalizing the collected data
+            for noduleAttribute in df.columns[1:]:
+                # print(allAttributes[noduleAttribute])
+                if isinstance(allAttributes[noduleAttribute][0], float):
+                    attributes[noduleAttribute] = np.mean(allAttributes[noduleAttribute])
+                elif isinstance(allAttributes[noduleAttribute][0], int):
+                    attributes[noduleAttribute] = stats.mode(allAttributes[noduleAttribute])
+                else:
+                    attributes[noduleAttribute] = allAttributes[noduleAttribute][0]
+            
+            # Convert the new row into a Dataframe, reset index, and add it to the main dataframe
+            df_new_nodule = pd.DataFrame.from_dict([attributes])
+            
+            # Concatenate ensuring index consistency
+            if verbose:
+                print(f"Before concat: df shape: {df.shape}, new nodule shape: {df_new_nodule.shape}")
+            
+            df = pd.concat([df, df_new_nodule], ignore_index=True)
+
+            if verbose:
+                print(f"After concat: df shape: {df.shape}")
+    
+    # Sort the dataframe based on the patient ID feature
+    df = df.sort_values(by=['nodule_id'], ascending=[True]).reset_index(drop=True)
+    
+    # Save the results into a .csv file
+    df.to_csv(pyradiomicsRefactoredFeaturesFilename, sep=',', index=False)
+
+    # Return the refactored dataframe
+    return df
+
+def benchmarkRefactorPyradiomicsDataset(df_pyradiomics:pd.DataFrame, repeats:int=1, verbose:bool=True) -> dict:
+    """
+    # Description
+        -> Compares the vectorized refactorPyradiomicsDataset against the previous implementation
+        on a pyradiomics dataset, checking that both produce the same nodules [Their features differ,
+        since the previous implementation paired each nodule with the first rows of its patient instead
+        of the rows of its annotations].
+    ---------------------------------------------------------------------------------------------
+    := param: df_pyradiomics - Pyradiomics dataset (as given to refactorPyradiomicsDataset) [With float64 features, since the previous implementation only averages those].
+    := param: repeats - Number of times each implementation is timed (the best time is kept).
+    := param: verbose - Whether or not to print the results.
+    := return: Dictionary with the best time (in seconds) of each implementation and the obtained speedup.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        legacyFilename = os.path.join(directory, 'legacy.csv')
+        vectorizedFilename = os.path.join(directory, 'vectorized.csv')
+
+        legacyTimes, vectorizedTimes = [], []
+        for _ in range(repeats):
+            start = perf_counter()
+            _legacyRefactorPyradiomicsDataset(df_pyradiomics.copy(), legacyFilename)
+            legacyTimes.append(perf_counter() - start)
+
+            start = perf_counter()
+            refactorPyradiomicsDataset(df_pyradiomics.copy(), vectorizedFilename)
+            vectorizedTimes.append(perf_counter() - start)
+
+        legacyNodules = pd.read_csv(legacyFilename, index_col=False, usecols=['nodule_id'])['nodule_id']
+        vectorizedNodules = pd.read_csv(vectorizedFilename, index_col=False, usecols=['nodule_id'])['nodule_id']
+        if not legacyNodules.equals(vectorizedNodules):
+            raise AssertionError('The refactored dataset has different nodules from the previous implementation!')
+
+    results = {
+        'legacy':min(legacyTimes),
+        'vectorized':min(vectorizedTimes),
+        'speedup':min(legacyTimes) / min(vectorizedTimes)
+    }
+
+    if verbose:
+        print(f"[{len(df_pyradiomics)} rows] Legacy: {results['legacy']:.4f}s | Vectorized: {results['vectorized']:.4f}s | Speedup: {results['speedup']:.1f}x")
+
+    return results
\ No newline at end of file
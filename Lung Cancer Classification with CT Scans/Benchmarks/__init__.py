@@ -0,0 +1,9 @@
+# This Python Package contains the code used to benchmark the optimized routines of the project against their previous implementations
+
+# Defining which submodules to import when using from <package> import *
+__all__ = ["benchmarkDuplicateSlicePruning", "checkBooleanMaskRegression", "benchmarkBooleanMask", "benchmarkAnnotationDiameters", "benchmarkSurfaceArea", "benchmarkResampling", "benchmarkDistanceMetrics", "benchmarkRefactorPyradiomicsDataset"]
+
+from .DicomLoadingBenchmarks import (benchmarkDuplicateSlicePruning)
+from .AnnotationBenchmarks import (checkBooleanMaskRegression, benchmarkBooleanMask, benchmarkAnnotationDiameters, benchmarkSurfaceArea, benchmarkResampling)
+from .DistanceMetricsBenchmarks import (benchmarkDistanceMetrics)
+from .PyradiomicsBenchmarks import (benchmarkRefactorPyradiomicsDataset)
\ No newline at end of file
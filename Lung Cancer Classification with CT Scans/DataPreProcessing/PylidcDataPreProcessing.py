@@ -1,9 +1,14 @@
 import numpy as np
 import pandas as pd
 import os
+import json
+import hashlib
 import customPylidc as pl
 from customPylidc import (ClusterError)
+from customPylidc.geometry import (annotation_diameters, annotation_volumes)
+from customPylidc.surface_area import (annotation_surface_areas)
 import statistics as stats
+from concurrent.futures import (ProcessPoolExecutor, as_completed)
 from sklearn.cluster import (KMeans)
 from sklearn.naive_bayes import (GaussianNB)
 
@@ -37,78 +42,267 @@ def createPylidcInitialDataframe() -> pd.DataFrame:
                             ])
     return df
 
-def extractPylidcFeatures(pylidcFeaturesFilename:str) -> pd.DataFrame:
+def _aggregateAnnotationValues(values:list):
     """
     # Description
-        -> This function aims to extract the important features from 
-           the CT data scans through the Pylidc package.
-           It will find the mode / mean values for each nodule's 
-           annotations throughout all the available patients.
-    ----------------------------------------------------------------
-    := param: pylidcFeaturesFilename - Path to save the final dataset.
-    := return: df - Dataframe with the propely formated results.
+        -> Combines the values of an attribute throughout the annotations
+        of a nodule into a single value (mean for floats and mode otherwise).
+    -------------------------------------------------------------------------
+    := param: values - List with the attribute value of each annotation.
+    := return: Aggregated value of the attribute.
     """
-    # Initialize the dataframe
-    df = createPylidcInitialDataframe()
-    
-    # Fetch all the Patient Ids Available
-    patientIds = sorted(np.unique([scan.patient_id for scan in pl.query(pl.Scan).all()]))
+    if isinstance(values[0], float):
+        return np.mean(values)
+    elif isinstance(values[0], int):
+        return stats.mode(values)
+    else:
+        return stats.mode(values)
+
+def _createPylidcSession():
+    """
+    # Description
+        -> Returns the session to the pylidc database of the current worker. The sessions
+        of customPylidc are local to each thread and are reset in forked processes, so
+        each worker process uses its own session instead of the one inherited from the parent.
+    -------------------------------------------------------------------------------------------
+    := return: Sqlalchemy session bound to the pylidc database.
+    """
+    return pl._session()
 
-    # Creating a list to store all the patient's whose nodule's clustering failed
-    failedClusterAnalysis = []
-    
-    # Iterate over all the patient Ids
+def _toPythonValue(value):
+    """
+    # Description
+        -> Converts a numpy scalar into the equivalent python value so that
+        the nodule rows can be stored in the JSON checkpoint.
+    -----------------------------------------------------------------------
+    := param: value - Value to convert.
+    := return: Python value [Floats keep the shortest representation of their original precision].
+    """
+    if isinstance(value, np.floating):
+        return float(str(value))
+    elif isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def computePatientHash(patientScan:pl.Scan) -> str:
+    """
+    # Description
+        -> Computes a hash over the annotations of a patient's scan (annotation ids and contour data),
+        used to detect whether a checkpointed patient has to be processed again.
+    ------------------------------------------------------------------------------------------------
+    := param: patientScan - Scan of the patient.
+    := return: Hexadecimal digest of the annotations' content.
+    """
+    content = [patientScan.id]
+    for annotation in sorted(patientScan.annotations, key=lambda a: a.id):
+        content.append([annotation.id, [[c.id, c.inclusion, c.image_z_position, c.coords] for c in annotation.contours]])
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+def loadPylidcCheckpoint(checkpointFilename:str) -> dict:
+    """
+    # Description
+        -> Loads the per-patient results stored in the append-only checkpoint file. When a patient
+        appears several times, its latest record is kept. Incomplete records (e.g. from a crash) are ignored.
+    ---------------------------------------------------------------------------------------------------------
+    := param: checkpointFilename - Path to the checkpoint (.jsonl) file.
+    := return: Dictionary mapping each patient id to its record (hash, status and nodule rows).
+    """
+    records = {}
+    if not os.path.exists(checkpointFilename):
+        return records
+    with open(checkpointFilename, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['patient_id']] = record
+    return records
+
+def _extractPatientsFeatures(patientIds:list, session=None, verbose:bool=True, knownHashes:dict=None, surfaceAreaMethod:str='marching_cubes', surfaceAreaWorkers:int=None) -> list:
+    """
+    # Description
+        -> Extracts the nodule features of a batch of patients. The scans, annotations,
+        contours and slice z values of the batch are eager loaded with a few queries.
+    -----------------------------------------------------------------------------------
+    := param: patientIds - List with the ids of the patients to process.
+    := param: session - Session used to query the pylidc database (a new one is created if None).
+    := param: verbose - Whether or not to print the progress.
+    := param: knownHashes - Dictionary with the hash of the already processed patients (if given, the hash of each patient is computed and the unchanged patients are skipped).
+    := param: surfaceAreaMethod - Method used to estimate the surface areas (see customPylidc.surface_area.methods).
+    := param: surfaceAreaWorkers - Number of threads used to compute the surface areas (defaults to the thread pool default).
+    := return: List with a record (patient id, hash, surface area method, status and nodule rows) per patient, in patient order.
+    """
+    # Create a session for the current worker
+    session = _createPylidcSession() if session is None else session
+
+    # Eager load the first scan of each patient and everything used to compute the features
+    patientScans = dict((scan.patient_id, scan) for scan in pl.load_cohort(patientIds, first_scan_only=True, session=session))
+
+    # Find the patients whose annotations changed since they were checkpointed [All of them if there are no checkpointed hashes]
+    patientHashes = dict((patientId, None if knownHashes is None else computePatientHash(patientScans[patientId])) for patientId in patientIds)
+    pendingPatientIds = set(patientId for patientId in patientIds if knownHashes is None or knownHashes.get(patientId) != patientHashes[patientId])
+
+    # Compute the diameters, volumes and surface areas of all the annotations of the pending patients in one call each
+    batchAnnotations = [annotation for patientId in patientIds if patientId in pendingPatientIds for annotation in patientScans[patientId].annotations]
+    batchAnnotationIds = [annotation.id for annotation in batchAnnotations]
+    batchValues = {
+        'diameter':dict(zip(batchAnnotationIds, annotation_diameters(batchAnnotations))),
+        'volume':dict(zip(batchAnnotationIds, annotation_volumes(batchAnnotations))),
+        'surface_area':dict(zip(batchAnnotationIds, annotation_surface_areas(batchAnnotations, method=surfaceAreaMethod, n_workers=surfaceAreaWorkers)))
+    }
+
+    # Find which features belong to the scan and which belong to the annotations
+    columns = list(createPylidcInitialDataframe().columns[1:])
+    scanColumns = [col for col in columns if hasattr(pl.Scan, col)]
+    annotationColumns = [col for col in columns if col not in scanColumns and hasattr(pl.Annotation, col)]
+    for col in columns:
+        if col not in scanColumns and col not in annotationColumns:
+            print(f"The attribute '{col}' does not exist in Annotation nor Scan classes.")
+
+    records = []
     for patientId in patientIds:
-        # Get all the Scans associated with the current patient
-        patientScan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patientId).first()
-        
+        patientScan = patientScans[patientId]
+        record = {'patient_id':patientId, 'hash':patientHashes[patientId], 'surface_area_method':surfaceAreaMethod, 'status':'done', 'rows':[]}
+
+        # Skip the patients whose annotations did not change since they were checkpointed
+        if patientId not in pendingPatientIds:
+            record['status'] = 'cached'
+            records.append(record)
+            continue
+
         try:
-            # Debug: print scan ID and basic info
-            print(f"Processing scan {patientScan.patient_id}")
-            
+            if verbose:
+                print(f"Processing scan {patientScan.patient_id}")
+
             # Fetch the nodes associated with each patient Scan
             patientNodules = patientScan.cluster_annotations(tol=2.0)
 
         except ClusterError:
             print(f"ClusterError for patient {patientId}, scan {patientScan.patient_id}. Adjusting tolerance.")
-            failedClusterAnalysis.append(patientId)
+            record['status'] = 'failed'
+            records.append(record)
             continue
-           
-        # Iterate over the patient nodules
+
+        # The scan features are the same for all the annotations
+        scanValues = dict((col, getattr(patientScan, col)) for col in scanColumns)
+
+        # Aggregate the features of each nodule throughout its annotations
         for noduleId, nodule in enumerate(patientNodules):
-            # Define a dictionary with the important features as keys and list with the current nodule
-            allAttributes = dict([(col, []) for col in df.columns[1:]])
-        
-            # Initialize a dictionary with the df's attributes / columns and empty strings
-            attributes  = dict((col, "") for col in df.columns)
-            
-            # Iterate over the nodule annotations and save the important attributes inside the allAttributes dictionary
-            for annotation in nodule:
-                for noduleAttribute in df.columns[1:]:
-                    if hasattr(patientScan, noduleAttribute):
-                        allAttributes[noduleAttribute] += [getattr(patientScan, noduleAttribute)]
-                    elif hasattr(annotation, noduleAttribute):
-                        allAttributes[noduleAttribute] += [getattr(annotation, noduleAttribute)]
-                    else:
-                        print(f"The attribute '{noduleAttribute}' does not exist in Annotation nor Scan classes.")
-
-            # Add an ID for the patient nodule
-            attributes['nodule_id'] = f"{patientId}-{noduleId + 1}"
-            
-            # Normalizing the collected data
-            for noduleAttribute in df.columns[1:]:
-                if isinstance(allAttributes[noduleAttribute][0], float):
-                    attributes[noduleAttribute] = np.mean(allAttributes[noduleAttribute])
-                elif isinstance(allAttributes[noduleAttribute][0], int):
-                    attributes[noduleAttribute] = stats.mode(allAttributes[noduleAttribute])
+            row = {'nodule_id':f"{patientId}-{noduleId + 1}"}
+            for col in columns:
+                if col in scanValues:
+                    values = [scanValues[col]]*len(nodule)
+                elif col in batchValues:
+                    values = [batchValues[col][annotation.id] for annotation in nodule]
+                elif col in annotationColumns:
+                    values = [getattr(annotation, col) for annotation in nodule]
                 else:
-                    attributes[noduleAttribute] = stats.mode(allAttributes[noduleAttribute])
-            
-            # Convert the new row into a Dataframe and add it to the previous one
-            df_new_nodule = pd.DataFrame.from_dict([attributes])
-            df = pd.concat([df, df_new_nodule], ignore_index=True)
+                    continue
+                row[col] = _toPythonValue(_aggregateAnnotationValues(values))
+            record['rows'].append(row)
+        records.append(record)
+
+    return records
+
+def _extractPatientsFeaturesWorker(patientIds:list, knownHashes:dict=None, surfaceAreaMethod:str='marching_cubes') -> list:
+    """
+    # Description
+        -> Process pool entry point of _extractPatientsFeatures. The surface areas are
+        computed in the worker's thread, since the batches already run in parallel.
+    ----------------------------------------------------------------------------------
+    := param: patientIds - List with the ids of the patients to process.
+    := param: knownHashes - Dictionary with the hash of the already processed patients.
+    := param: surfaceAreaMethod - Method used to estimate the surface areas.
+    := return: List with a record per patient.
+    """
+    return _extractPatientsFeatures(patientIds, knownHashes=knownHashes, surfaceAreaMethod=surfaceAreaMethod, surfaceAreaWorkers=1)
+
+def extractPylidcFeatures(pylidcFeaturesFilename:str, numWorkers:int=None, patientIds:list=None, chunkSize:int=16, checkpointFilename:str=None, surfaceAreaMethod:str='marching_cubes') -> pd.DataFrame:
+    """
+    # Description
+        -> This function aims to extract the important features from 
+           the CT data scans through the Pylidc package.
+           It will find the mode / mean values for each nodule's 
+           annotations throughout all the available patients.
+           The patients are split into batches which are processed
+           in parallel, and the dataframe is built once at the end.
+           If a checkpoint file is given, the results of each patient are
+           appended to it as soon as its batch finishes, so an interrupted
+           extraction resumes where it stopped and only the patients whose
+           annotations changed are processed again.
+    ----------------------------------------------------------------
+    := param: pylidcFeaturesFilename - Path to save the final dataset.
+    := param: numWorkers - Number of worker processes (defaults to the number of CPUs, 1 processes the patients in the current process).
+    := param: patientIds - List with the ids of the patients to process (defaults to all the available patients) [A ValueError is raised if any of them is not in the pylidc database].
+    := param: chunkSize - Number of patients processed by each batch.
+    := param: checkpointFilename - Path to the append-only (.jsonl) checkpoint file (None disables the checkpoints).
+    := param: surfaceAreaMethod - Method used to estimate the surface areas of each batch at once: 'marching_cubes' (as Annotation.surface_area) or the faster 'faces' approximation for bulk runs.
+    := return: df - Dataframe with the propely formated results.
+    """
+    # Fetch all the Patient Ids Available
+    availablePatientIds = [patientId for (patientId,) in pl.query(pl.Scan.patient_id).distinct()]
+    if patientIds is None:
+        patientIds = availablePatientIds
+    patientIds = [str(patientId) for patientId in sorted(np.unique(patientIds))]
+
+    # Check that all the given patients exist in the pylidc database
+    unknownPatientIds = sorted(set(patientIds) - set(availablePatientIds))
+    if len(unknownPatientIds) > 0:
+        raise ValueError(f"Patients not found inside the pylidc database: {unknownPatientIds}")
+
+    # Load the previously processed patients
+    records = {}
+    knownHashes = None
+    if checkpointFilename is not None:
+        records = loadPylidcCheckpoint(checkpointFilename)
+        # [Only the patients processed with the same surface area method are reused]
+        knownHashes = dict((patientId, record['hash']) for patientId, record in records.items() if record.get('surface_area_method', 'marching_cubes') == surfaceAreaMethod)
+
+        # Terminate the last record if it was left incomplete by an interrupted run
+        if os.path.exists(checkpointFilename) and os.path.getsize(checkpointFilename) > 0:
+            with open(checkpointFilename, 'rb+') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    file.write(b'\n')
+
+    # Split the patients into batches
+    chunks = [patientIds[i:i + chunkSize] for i in range(0, len(patientIds), chunkSize)]
+    numWorkers = os.cpu_count() if numWorkers is None else numWorkers
+
+    def saveBatch(batchRecords:list) -> None:
+        # Store the new results (and append them to the checkpoint)
+        newRecords = [record for record in batchRecords if record['status'] != 'cached']
+        for record in newRecords:
+            records[record['patient_id']] = record
+        if checkpointFilename is not None and len(newRecords) > 0:
+            with open(checkpointFilename, 'a') as file:
+                for record in newRecords:
+                    file.write(json.dumps(record) + '\n')
+
+    # Process the batches
+    if numWorkers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            saveBatch(_extractPatientsFeatures(chunk, pl._session, knownHashes=knownHashes, surfaceAreaMethod=surfaceAreaMethod))
+    else:
+        with ProcessPoolExecutor(max_workers=min(numWorkers, len(chunks))) as pool:
+            futures = [pool.submit(_extractPatientsFeaturesWorker, chunk, knownHashes, surfaceAreaMethod) for chunk in chunks]
+            for future in as_completed(futures):
+                saveBatch(future.result())
+
+    # Gather the nodules in column arrays [Following the patients order, so the output is deterministic]
+    columns = createPylidcInitialDataframe().columns
+    data = dict((col, []) for col in columns)
+    failedClusterAnalysis = []
+    for patientId in patientIds:
+        if records[patientId]['status'] == 'failed':
+            failedClusterAnalysis.append(patientId)
+        for row in records[patientId]['rows']:
+            for col in columns:
+                data[col].append(row.get(col, ""))
 
-    # Sort the dataframe based on the patient ID feature
+    # Build the dataframe at once and sort it based on the patient ID feature
+    df = pd.DataFrame(data, columns=columns)
     df = df.sort_values(by=['nodule_id'], ascending=[True])
     
     # Save the results into a .csv file
@@ -1,7 +1,79 @@
 import numpy as np
 import pandas as pd
 import customPylidc as pl
-import statistics as stats
+import warnings
+
+def loadPyradiomicsDataset(pyradiomicsFeaturesFilename:str, floatDtype:type=np.float32, shiftedColumnsStart:int=143, shift:int=273, dropMissing:bool=True) -> pd.DataFrame:
+    """
+    # Description
+        -> Loads the pyradiomics features dataset with explicit types (floats with the given
+        precision and strings as categories), splits the annotation ids into the patient and
+        annotation ids, realigns the rows whose features were shifted and drops the rows with missing values.
+    ---------------------------------------------------------------------------------------------------------
+    := param: pyradiomicsFeaturesFilename - Path to the .csv file with the extracted pyradiomics features.
+    := param: floatDtype - Type of the float features.
+    := param: shiftedColumnsStart - Index (after splitting the ids) of the first column of the features that may be shifted.
+    := param: shift - Number of columns by which the features of a row with missing values are shifted [0 keeps the rows as they are].
+    := param: dropMissing - Whether or not to drop the rows with missing values [Including the realigned ones].
+    := return: Pandas dataframe with the 'patient_id' and 'ann_id' columns followed by the features.
+    """
+    # Add Restrictions to the Loading
+    if shift < 0:
+        raise ValueError(f'Invalid shift ({shift})! The features can only be shifted to the right')
+
+    # Infer the type of each feature from the first rows
+    sample = pd.read_csv(pyradiomicsFeaturesFilename, index_col=False, nrows=100)
+    idColumn = sample.columns[0]
+    dtypes = dict((col, floatDtype) for col in sample.columns[1:] if sample[col].dtype.kind == 'f')
+    dtypes.update((col, 'category') for col in sample.columns[1:] if pd.api.types.is_string_dtype(sample[col].dtype))
+
+    # Read the whole dataset with those types [Converting the features after reading them if some rows do not match the sample]
+    try:
+        df = pd.read_csv(pyradiomicsFeaturesFilename, index_col=False, dtype=dtypes)
+    except (ValueError, TypeError):
+        df = pd.read_csv(pyradiomicsFeaturesFilename, index_col=False)
+        df = df.astype(dict((col, floatDtype if df[col].dtype.kind == 'f' else 'category') for col in dtypes))
+
+    # Split the 'annotation_id' column into 'patient_id' and 'ann_id' and move them to the beginning [Removing the annotation id column]
+    ids = df[idColumn].astype(str).str.rsplit('-', n=1, expand=True)
+    ids.columns = ['patient_id', 'ann_id']
+    df = pd.concat([ids, df.drop(columns=[idColumn])], axis=1)
+
+    # Find the rows with missing values among the shifted features
+    shiftedColumns = df.columns[shiftedColumnsStart:]
+    shiftedRows = df[shiftedColumns].isna().to_numpy().any(axis=1)
+
+    if dropMissing:
+        # Drop rows with NaN Values [The realigned rows always have missing values in their first shifted columns, so they are dropped as well]
+        df = df[~shiftedRows].dropna(how='any')
+    elif shift > 0 and shiftedRows.any():
+        # Realign the shifted rows [Moving their values shift columns to the right]
+        shifted = df[shiftedColumns]
+        if shifted.dtypes.nunique() == 1 and shifted.dtypes.iloc[0].kind == 'f':
+            # All the shifted features share a float type [Shift the rows inside a single matrix]
+            values = shifted.to_numpy(copy=True)
+            values[shiftedRows, shift:] = values[shiftedRows, :-shift]
+            values[shiftedRows, :shift] = np.nan
+            shifted = pd.DataFrame(values, index=df.index, columns=shiftedColumns)
+        else:
+            shifted = pd.concat([shifted.loc[~shiftedRows], shifted.loc[shiftedRows].shift(shift, axis=1)]).loc[df.index]
+        df = pd.concat([df[df.columns[:shiftedColumnsStart]], shifted], axis=1)
+
+    return df
+
+def _modeOfGroups(keys:np.ndarray, values:np.ndarray) -> pd.Series:
+    """
+    # Description
+        -> Computes the mode of the values of each group at once. As statistics.mode,
+        ties are broken by the value that appears first inside the group.
+    ---------------------------------------------------------------------------------
+    := param: keys - Group of each value.
+    := param: values - Values to reduce.
+    := return: Pandas series with the mode of each group (indexed by the sorted group keys).
+    """
+    counts = pd.DataFrame({'key':keys, 'value':values, 'position':np.arange(len(keys))}).groupby(['key', 'value'], sort=False)['position'].agg(['size', 'min'])
+    counts = counts.reset_index().sort_values(by=['key', 'size', 'min'], ascending=[True, False, True], kind='stable')
+    return counts.drop_duplicates(subset='key').set_index('key')['value']
 
 def refactorPyradiomicsDataset(df_pyradiomics:pd.DataFrame, pyradiomicsRefactoredFeaturesFilename:str, verbose:bool=False) -> pd.DataFrame:
     """
@@ -9,6 +81,11 @@ def refactorPyradiomicsDataset(df_pyradiomics:pd.DataFrame, pyradiomicsRefactore
         -> This function aims to refactor the pyradiomics dataset so that we take into
         consideration the mode / average values for all the nodules features parting
         from the annotations of the nodules provided by the pyradiomics_feature dataset.
+        The patient / annotation ids of the rows are parsed once, each row is mapped to its
+        nodule through an annotation -> nodule table [The n-th segmentation of a patient is
+        the n-th annotation (by id) of its first scan] and all the nodules are aggregated at
+        once (the mean for the float features, the mode for the integer ones and the value
+        of the first annotation otherwise).
     -----------------------------------------------------------------------------------
     := param: df_pyradiomics - Extracted dataframe with the raw information.
     := param: pyradiomicsFeaturesFilename - Path to save the refactored version of the dataset.
@@ -18,148 +95,137 @@ def refactorPyradiomicsDataset(df_pyradiomics:pd.DataFrame, pyradiomicsRefactore
     # Define the columns for the refactored pyradiomics dataset
     cols = ['nodule_id'] + list(df_pyradiomics.columns)
 
-    # Create a new empty dataframe for the refactored dataset
-    df = pd.DataFrame(columns=cols)
+    # Parse the patient / annotation ids of every row [Split into the 'patient_id' and 'ann_id' columns when loading the dataset, otherwise held by the first column]
+    if 'patient_id' in df_pyradiomics.columns and 'ann_id' in df_pyradiomics.columns:
+        ids = df_pyradiomics[['patient_id', 'ann_id']].astype(str)
+    else:
+        ids = df_pyradiomics[df_pyradiomics.columns[0]].astype(str).str.rsplit('-', n=1, expand=True)
+    ids.columns = ['patient_id', 'ann_id']
+    rowAnnotationIds = ids['patient_id'] + '-' + ids['ann_id']
+    datasetPatientIds = set(ids['patient_id'])
 
-    # Fetch all the Patient Ids Available
-    patientIds = sorted(np.unique([scan.patient_id for scan in pl.query(pl.Scan).all()]))
-
-    # Iterate over all the patient Ids
-    for patientId in patientIds:
-        if verbose:
-            print(f"\n-> [NEW PATIENT: {patientId}]\n")
-        
-        # Fetch the patient's scan
-        patientScan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patientId).first()
-
-        # Creating a mask to filter the current patient data from the pyradiomics dataframe
-        mask = df_pyradiomics[df_pyradiomics.columns[0]].str.contains(patientId)
-        
-        # Get the segment of the dataframe with the current patient
-        pyradiomicsPatientDf = df_pyradiomics.loc[mask]
-
-        if pyradiomicsPatientDf.shape[0] == 0:
+    # Build the annotation -> nodule table
+    annotationNodules = {}
+    for patientScan in pl.load_cohort(first_scan_only=True):
+        patientId = patientScan.patient_id
+        if patientId not in datasetPatientIds:
             print(f"Patient {patientId} not found inside the Pyradiomics extracted dataset!")
             continue
-        
-        if verbose:
-            print(f"Patient dataframe shape: {pyradiomicsPatientDf.shape}")
-        
-        # Get the Patient Nodules Annotations
+
+        # Get the Patient Nodules Annotations [Numbered as the patient's segmentations]
+        annotationNumbers = dict((annotation.id, number + 1) for number, annotation in enumerate(patientScan.annotations))
         patientNodules = patientScan.cluster_annotations()
 
         if verbose:
-            print(f"Number of nodules: {len(patientNodules)}")
-        
-        # Iterate over the patient nodules
+            print(f"-> [PATIENT: {patientId}] Annotations: {len(annotationNumbers)} | Nodules: {len(patientNodules)}")
+
         for noduleId, nodule in enumerate(patientNodules):
-            if verbose:
-                print(f"[NEW NODULE: {noduleId + 1}]")
-                print(f"Number of annotations: {len(nodule)}")
-            
-            # Check that the nodule list is not empty
-            if len(nodule) == 0:
-                print(f"Skipping empty nodule: {noduleId}")
-                continue
-            
-            # Define a dictionary with the important features as keys and list with the current nodule
-            allAttributes = dict([(col, []) for col in df.columns[1:]])
-        
-            # Initialize a dictionary with the df's attributes / columns and empty strings
-            attributes = dict((col, "") for col in df.columns)
-            
-            # Iterate over the nodule annotations and save the important attributes inside the allAttributes dictionary
-            for currentAnnotation in range(len(nodule)):
-                if verbose:
-                    print(f"[NEW ANNOTATION: {currentAnnotation + 1}]")
-                
-                # Check if the number of annotations matches
-                if currentAnnotation >= pyradiomicsPatientDf.shape[0]:
-                    print(f"Skipping invalid annotation at index {currentAnnotation}")
-                    continue
-                
-                for noduleAttribute in df.columns[1:]:
-                    try:
-                        allAttributes[noduleAttribute] += [pyradiomicsPatientDf[noduleAttribute].values[currentAnnotation]]
-                    except KeyError:
-                        print(f"Skipping unknown attribute: {noduleAttribute}")
-                        continue
-
-            # Add an ID for the patient nodule
-            attributes['nodule_id'] = f"{patientId}-{noduleId + 1}"
-            
-            # Normalizing the collected data
-            for noduleAttribute in df.columns[1:]:
-                # print(allAttributes[noduleAttribute])
-                if isinstance(allAttributes[noduleAttribute][0], float):
-                    attributes[noduleAttribute] = np.mean(allAttributes[noduleAttribute])
-                elif isinstance(allAttributes[noduleAttribute][0], int):
-                    attributes[noduleAttribute] = stats.mode(allAttributes[noduleAttribute])
-                else:
-                    attributes[noduleAttribute] = allAttributes[noduleAttribute][0]
-            
-            # Convert the new row into a Dataframe, reset index, and add it to the main dataframe
-            df_new_nodule = pd.DataFrame.from_dict([attributes])
-            
-            # Concatenate ensuring index consistency
-            if verbose:
-                print(f"Before concat: df shape: {df.shape}, new nodule shape: {df_new_nodule.shape}")
-            
-            df = pd.concat([df, df_new_nodule], ignore_index=True)
-
-            if verbose:
-                print(f"After concat: df shape: {df.shape}")
-    
-    # Sort the dataframe based on the patient ID feature
-    df = df.sort_values(by=['nodule_id'], ascending=[True]).reset_index(drop=True)
-    
+            for annotation in nodule:
+                annotationNodules[f"{patientId}-{annotationNumbers[annotation.id]}"] = f"{patientId}-{noduleId + 1}"
+
+    # Map every row to its nodule [Rows without a matching annotation are left out]
+    rowNoduleIds = rowAnnotationIds.map(annotationNodules).to_numpy()
+    matched = pd.notna(rowNoduleIds)
+    if verbose and not matched.all():
+        print(f"Skipping {np.count_nonzero(~matched)} rows without a matching annotation: {list(rowAnnotationIds[~matched])}")
+    df_matched = df_pyradiomics.loc[matched]
+    keys = rowNoduleIds[matched]
+
+    # Aggregate the features of each nodule [The mean for the float features (computed with a 64 bits precision), the mode for the integer ones and the first annotation's value otherwise]
+    noduleRows = df_matched.groupby(keys).indices
+    noduleIds = sorted(noduleRows)
+    firstRows = df_matched.iloc[[noduleRows[noduleId][0] for noduleId in noduleIds]]
+    data = {}
+    floatColumns = [col for col in df_matched.columns if df_matched[col].dtype.kind == 'f']
+    if len(floatColumns) > 0:
+        data.update(df_matched[floatColumns].astype(np.float64).groupby(keys).mean().to_dict('series'))
+    for col in df_matched.columns:
+        if df_matched[col].dtype.kind in 'iu':
+            data[col] = _modeOfGroups(keys, df_matched[col].to_numpy())
+        elif col not in data:
+            data[col] = pd.Series(firstRows[col].to_numpy(), index=noduleIds)
+
+    df = pd.DataFrame(data, index=noduleIds)
+    df.insert(0, 'nodule_id', noduleIds)
+    df = df[cols].reset_index(drop=True)
+
     # Save the results into a .csv file
     df.to_csv(pyradiomicsRefactoredFeaturesFilename, sep=',', index=False)
 
     # Return the refactored dataframe
     return df
 
+def _parseTupleStrings(values:np.ndarray, verbose:bool=False) -> tuple:
+    """
+    # Description
+        -> Parses tuple-like strings [e.g., "(0.7, 0.7, 2.5)"] into a float matrix. The stripped
+        strings are joined and converted by numpy in a single call, and the values are only parsed
+        one at a time if some of them are not well formed.
+    ----------------------------------------------------------------------------------------------
+    := param: values - Array with the tuple-like strings [Values which are not strings can not be parsed].
+    := param: verbose - Boolean value which decides whether or not to report the values that can not be parsed.
+    := return: Float matrix with a row per value (padded with NaN) and the number of elements of each value (0 if it could not be parsed).
+    """
+    numbers = None
+    if all(isinstance(value, str) for value in values):
+        # Strip the parentheses and parse all the comma separated elements at once
+        stripped = [value.strip('()') for value in values]
+        lengths = np.array([value.count(',') + 1 for value in stripped], dtype=np.int64)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            try:
+                numbers = np.fromstring(','.join(stripped), sep=',')
+            except (ValueError, DeprecationWarning):
+                numbers = None
+        if numbers is not None and len(numbers) != lengths.sum():
+            numbers = None
+
+    if numbers is None:
+        # Parse the values one at a time [Values that can not be parsed have no elements]
+        parsed = []
+        for value in values:
+            try:
+                parsed.append([float(x) for x in value.strip('()').split(',')])
+            except Exception as e:
+                if verbose:
+                    print(f"Error parsing value '{value}': {e}")
+                parsed.append([])
+        lengths = np.array([len(t) for t in parsed], dtype=np.int64)
+        numbers = np.array([x for t in parsed for x in t], dtype=np.float64)
+
+    # Place the elements of each value in its row
+    matrix = np.full((len(values), lengths.max() if len(values) > 0 else 0), np.nan)
+    rows = np.repeat(np.arange(len(values)), lengths)
+    matrix[rows, np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)] = numbers
+    return matrix, lengths
+
 def mapTuplesInsideDataframe(df:pd.DataFrame, columnsToParse:list, verbose:bool=False) -> pd.DataFrame:
     """
     # Description
         -> Maps the tuple-like strings from multiple columns inside
         the DataFrame into separate columns for each one of its elements.
+        The values of all the columns are parsed in one pass and the new
+        columns are joined to the DataFrame at once.
     ---------------------------------------------------------------------
     := param: df - The input DataFrame.
     := param: columnsToParse - A list of the columns whose content is composed by tuple-like strings.
     := param: verbose - Boolean value which decides whether or not to provide additional information during the function execution.
     := return: The DataFrame with new columns added for each tuple-like string.
     """
-    
-    # Iterate over the columns provided
-    for column in columnsToParse:
-        if verbose:
-            print(f"Processing column: {column}")
-        
-        # Create a list to store the extracted values
-        tupleValues = []
-        
-        # Iterate over each row in the specified column
-        for value in df[column]:
-            # Remove parentheses and split by commas
-            try:
-                # Strip the parentheses and split by comma
-                parsedValues = [float(x) for x in value.strip('()').split(',')]
-            except Exception as e:
-                # Handle cases where the value can't be parsed properly
-                if verbose:
-                    print(f"Error parsing value '{value}' in column '{column}': {e}")
-                parsedValues = []
+    columnsToParse = list(columnsToParse)
+    if verbose:
+        print(f"Processing columns: {columnsToParse}")
 
-            # Append the parsed values (tuple) to the list
-            tupleValues.append(parsedValues)
-        
-        # Create new columns from the extracted values
-        # Only as many columns as needed for each tuple length
-        for i in range(max(len(t) for t in tupleValues)):
-            df[f"{column}_{i+1}"] = [t[i] if i < len(t) else None for t in tupleValues]
+    # Parse the values of all the columns at once [Column after column]
+    numbers, lengths = _parseTupleStrings(df[columnsToParse].to_numpy(dtype=object).ravel(order='F'), verbose=verbose)
 
-        # Drop the original column after processing, if desired
-        df.drop(columns=[column], inplace=True)
+    # Create new columns from the extracted values [Only as many columns as needed for each tuple length]
+    newColumns = {}
+    for index, column in enumerate(columnsToParse):
+        rows = slice(index*len(df), (index + 1)*len(df))
+        for i in range(lengths[rows].max()):
+            newColumns[f"{column}_{i+1}"] = numbers[rows, i]
 
-    return df
\ No newline at end of file
+    # Drop the original columns and join the new ones [Replacing the existing columns with the same name]
+    remainingColumns = [column for column in df.columns if column not in columnsToParse and column not in newColumns]
+    return pd.concat([df[remainingColumns], pd.DataFrame(newColumns, index=df.index)], axis=1)
\ No newline at end of file
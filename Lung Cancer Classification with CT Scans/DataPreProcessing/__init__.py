@@ -2,11 +2,11 @@
 
 # Defining which submodules to import when using from <package> import *
 __all__ = ["createPylidcInitialDataframe", "extractPylidcFeatures", "processIndeterminateNodules", "binarizeTargetLabel",
-           "refactorPyradiomicsDataset", "mapTuplesInsideDataframe",
+           "loadPyradiomicsDataset", "refactorPyradiomicsDataset", "mapTuplesInsideDataframe",
            "performDataNormalization", "removeHighlyCorrelatedFeatures",
            "pastelizeColor", "plotFeatureDistribution"]
 
 from .PylidcDataPreProcessing import (createPylidcInitialDataframe, extractPylidcFeatures, processIndeterminateNodules, binarizeTargetLabel)
-from .PyradiomicsDataPreProcessing import (refactorPyradiomicsDataset, mapTuplesInsideDataframe)
+from .PyradiomicsDataPreProcessing import (loadPyradiomicsDataset, refactorPyradiomicsDataset, mapTuplesInsideDataframe)
 from .DataPreProcessing import (performDataNormalization, removeHighlyCorrelatedFeatures)
 from .DataVisualization import (pastelizeColor, plotFeatureDistribution)
\ No newline at end of file
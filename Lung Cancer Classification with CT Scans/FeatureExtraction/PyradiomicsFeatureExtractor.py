@@ -1,97 +1,291 @@
 import os
+import json
+import sys
+import shutil
+import importlib
+from concurrent.futures import (ProcessPoolExecutor)
+
+# Module of each worker process [Set by _initializeWorker]
+_pyradiomicsDcm = None
+
+def loadPyradiomicsDcmModule(pyradiomicsDcmScriptPath:str):
+    """
+    # Description
+        -> Imports the pyradiomics-dcm.py script as a module, so that its functions can be used without running it as a subprocess.
+        The script's directory is added to the path so that worker processes can also import it (and unpickle its functions).
+    -------------------------------------------------------------------------------------------------------------------------------
+    := param: pyradiomicsDcmScriptPath - Path to the pyradiomics-dcm.py script.
+    := return: The loaded module.
+    """
+    scriptDirectory, scriptFilename = os.path.split(os.path.abspath(pyradiomicsDcmScriptPath))
+    if scriptDirectory not in sys.path:
+        sys.path.append(scriptDirectory)
+    return importlib.import_module(os.path.splitext(scriptFilename)[0])
+
+def _initializeWorker(pyradiomicsDcmScriptPath:str, pyradiomicsParamsFilePath:str) -> None:
+    """
+    # Description
+        -> Process pool initializer: loads the pyradiomics-dcm.py module and initializes its feature extractor once per worker,
+        so that the same pool converts the series and extracts their features across all the batches.
+    ----------------------------------------------------------------------------------------------------------------------------
+    := param: pyradiomicsDcmScriptPath - Path to the pyradiomics-dcm.py script.
+    := param: pyradiomicsParamsFilePath - Path to the Pyradiomics_Params.yaml file.
+    := return: None, since the module is stored as a global of the worker.
+    """
+    global _pyradiomicsDcm
+    _pyradiomicsDcm = loadPyradiomicsDcmModule(pyradiomicsDcmScriptPath)
+    _pyradiomicsDcm.initializeWorker(pyradiomicsParamsFilePath)
+
+def findPatientSeries(Lidc_IdrFilesPath:str, startPatient:int=0) -> list:
+    """
+    # Description
+        -> Finds the CT series of each patient of the LIDC-IDR dataset alongside its segmentation files.
+    ----------------------------------------------------------------------------------------------------
+    := param: Lidc_IdrFilesPath - Global path for files from the LIDC-IDR dataset.
+    := param: startPatient - Number of the Patient to start the extraction from.
+    := return: List of (patient, series directory, list of (name, segmentation file)) tuples [The names follow the <Patient_Name>-<Segmentation_Number> nomenclature].
+    """
+    series = []
+
+    # Iterate through all the Patients [Sorted so that the segmentation numbers are deterministic]
+    for patient in sorted(os.listdir(Lidc_IdrFilesPath)):
+        patientPath = os.path.join(Lidc_IdrFilesPath, patient)
+
+        # Skip the output and temp directories alonsgside all the unnecessary patient files (according to the initial patient) and other non-directory files
+        if (not os.path.isdir(patientPath)) or patient == "OutputSR" or patient == "TempDir" or startPatient > int(patient[len(patient)-4:]):
+            continue
+
+        # Finding the CT-scan folder (has the most content - directories with each segmentation and directory with the input DICOM series)
+        path = ""
+        content = 0
+        for folder in sorted(os.listdir(patientPath)):
+            segmentations_or_series = os.listdir(os.path.join(patientPath, folder))
+            if (len(segmentations_or_series) > content):
+                content = len(segmentations_or_series)
+                path = folder
+
+        # Save the Directory with the Patient's Scans
+        scansPath = os.path.join(patientPath, path)
+        patientScansFolder = sorted(os.listdir(scansPath))
+
+        # Finding the series folder
+        main = ""
+        for folder in patientScansFolder:
+            if not "Annotation" in folder:
+                main = folder
+                break
+
+        # Name each segmentation of the patient
+        segmentations = [folder for folder in patientScansFolder if "Segmentation" in folder]
+        segmentations = [(f"{patient}-{index + 1}", os.path.join(scansPath, folder, "1-1.dcm")) for index, folder in enumerate(segmentations)]
+
+        series.append((patient, os.path.join(scansPath, main), segmentations))
+
+    return series
+
+def _seriesTempDirectoryPath(tempDirectoryPath:str, patient:str) -> str:
+    """
+    # Description
+        -> Path to the directory with the intermediate results of the conversion of a patient's series.
+    ---------------------------------------------------------------------------------------------------
+    := param: tempDirectoryPath - Path to the directory to store intermediate results.
+    := param: patient - Name of the patient.
+    := return: Path to the series temporary directory.
+    """
+    return os.path.join(tempDirectoryPath, patient)
+
+def _convertSeries(patient:str, seriesPath:str, segmentations:list, tempDirectoryPath:str, volumeReconstructor:str) -> list:
+    """
+    # Description
+        -> Converts a CT series once and splits all its segmentations into segments.
+    --------------------------------------------------------------------------------
+    := param: patient - Name of the patient.
+    := param: seriesPath - Path to the directory with the DICOM series.
+    := param: segmentations - List of (name, segmentation file) tuples.
+    := param: tempDirectoryPath - Path to the directory to store intermediate results.
+    := param: volumeReconstructor - Tool used to convert the series ("plastimatch" or "dcm2niix").
+    := return: List with the (name, image, mask, label) extraction job of each segment.
+    """
+    # Each series gets its own temporary directory
+    seriesTempPath = _seriesTempDirectoryPath(tempDirectoryPath, patient)
+    os.makedirs(seriesTempPath, exist_ok=True)
+
+    # Convert the DICOM series into a volume [Only once for all the segmentations]
+    if volumeReconstructor == "plastimatch":
+        inputImage = _pyradiomicsDcm.dcmImageToNRRD(seriesPath, seriesTempPath)
+    else:
+        inputImage = _pyradiomicsDcm.dcmImageToNIfTI(seriesPath, seriesTempPath)
+
+    jobs = []
+    for segIndex, (name, segmentationFile) in enumerate(segmentations):
+        print(f"\n\nPACIENT [{patient}] - SEGMENTATION [{segIndex + 1}]")
+
+        # Convert the segmentation into segments [In its own directory so that segments of different segmentations are not mixed]
+        segmentationTempPath = os.path.join(seriesTempPath, str(segIndex + 1))
+        os.makedirs(segmentationTempPath, exist_ok=True)
+        inputSegments = sorted(_pyradiomicsDcm.dcmSEGToNRRDs(segmentationFile, segmentationTempPath))
+
+        for inputSegment in inputSegments:
+            segmentNumber = os.path.split(inputSegment)[-1].split('.')[0]
+            jobs.append((name, inputImage, inputSegment, int(segmentNumber)))
+
+    return jobs
+
+def loadPyradiomicsManifest(manifestFileName:str) -> tuple:
+    """
+    # Description
+        -> Loads the series recorded in the manifest of the extraction. Each batch is recorded by a single line
+        alongside the size of the features .csv file once its rows were merged, so a batch whose line is incomplete
+        (e.g. from a crash) is ignored as a whole.
+    ----------------------------------------------------------------------------------------------------------------
+    := param: manifestFileName - Path to the manifest (.jsonl) file.
+    := return: Set with the processed series and the size of the features file after the last recorded batch (None if no batch was recorded).
+    """
+    processedSeries = set()
+    featuresSize = None
+    if not os.path.exists(manifestFileName):
+        return processedSeries, featuresSize
+
+    with open(manifestFileName, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            processedSeries.update(entry['series'])
+            featuresSize = entry['featuresSize']
+
+    return processedSeries, featuresSize
+
+def _recordPyradiomicsBatch(manifestFileName:str, batch:list, featuresFileName:str) -> None:
+    """
+    # Description
+        -> Appends the series of a batch to the manifest in a single line, alongside the current size of the features file.
+    ------------------------------------------------------------------------------------------------------------------------
+    := param: manifestFileName - Path to the manifest (.jsonl) file.
+    := param: batch - List of (patient, series directory, segmentations) tuples.
+    := param: featuresFileName - Path to the features .csv file.
+    := return: None, since the entry is written to the manifest.
+    """
+    featuresSize = os.path.getsize(featuresFileName) if os.path.exists(featuresFileName) else 0
+    with open(manifestFileName, 'a') as file:
+        file.write(json.dumps({'patients':[job[0] for job in batch], 'series':[job[1] for job in batch], 'featuresSize':featuresSize}) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+def _convertSeriesWorker(job:tuple, tempDirectoryPath:str, volumeReconstructor:str) -> list:
+    """
+    # Description
+        -> Process pool entry point of _convertSeries.
+    --------------------------------------------------
+    := param: job - Tuple with the patient, series directory and segmentations.
+    := param: tempDirectoryPath - Path to the directory to store intermediate results.
+    := param: volumeReconstructor - Tool used to convert the series.
+    := return: List with the extraction jobs of the series.
+    """
+    patient, seriesPath, segmentations = job
+    return _convertSeries(patient, seriesPath, segmentations, tempDirectoryPath, volumeReconstructor)
 
 def extractPyradiomicsFeatures(Lidc_IdrFilesPath:str=None,
                                pyradiomicsDcmScriptPath:str=None,
                                pyradiomicsParamsFilePath:str=None,
-                               pyradiomicsFeatureDictFilePath:str=None,
                                startPatient:int=None,
-                               outputDirectoryPath:str=None,
-                               tempDirectoryPath:str=None) -> None:
-    
+                               tempDirectoryPath:str=None,
+                               numWorkers:int=None,
+                               volumeReconstructor:str="plastimatch",
+                               batchSize:int=32) -> None:
+
     """
     # Description
         -> This script iterates through all the patient's folders extracting important data from the .dcm files into a pyradiomics_features.csv file
+        [The DICOM SR with the features is only written when running the pyradiomics-dcm.py script from the command line].
+        Each CT series is converted once and all its segmentations are processed against it. The series are processed in batches: the conversions
+        are distributed across a process pool (created once per run) and the features are extracted on the same pool with the extraction API of pyradiomics-dcm.py (one extractor per worker).
+        The processed series are recorded in a manifest, so an interrupted extraction resumes where it stopped [The rows merged by
+        a batch that was not recorded are removed from the features file before resuming], and the intermediate files of each batch
+        are removed once its features are merged.
     ------------------------------------------------------------------------------------------------------------------------------------------------
     := param: Lidc_IdrFilesPath - Global path for files from the LIDC-IDR dataset.
     := param: pyradiomicsDcmScriptPath - Path to the pyradiomics-dcm.py script used to extract features from the images on the dataset [Available on the pyradiomics GitHub Repository: https://github.com/AIM-Harvard/pyradiomics/tree/master/labs/pyradiomics-dcm].
     := param: pyradiomicsParamsFilePath - Path for the parameters file with the Pyradiomics feature extractor positional arguments [Available on the pyradiomics GitHub Repository: https://github.com/AIM-Harvard/pyradiomics/tree/master/labs/pyradiomics-dcm].
-    := param: pyradiomicsFeatureDictFilePath - Path for the features to be considered during the extraction [Available on the pyradiomics GitHub Repository: https://github.com/AIM-Harvard/pyradiomics/blob/master/labs/pyradiomics-dcm/resources/featuresDict_IBSIv7.tsv].
     := param: startPatient - Number of the Patient to start the extraction from [Allows a better feature extraction management].
-    := param: outputDirectoryPath - Path to the directory for saving the resulting DICOM file.
-    := param: tempDirectoryPath - Path to the directory to store intermediate results [Including the pyradiomic_features.csv].
+    := param: tempDirectoryPath - Path to the directory to store intermediate results [Including the pyradiomic_features.csv] [A relative path is resolved against the LIDC-IDR dataset path].
+    := param: numWorkers - Number of worker processes (defaults to the number of CPUs).
+    := param: volumeReconstructor - Tool used to convert the DICOM series ("plastimatch" or "dcm2niix").
+    := param: batchSize - Number of series whose features are extracted (and recorded in the manifest) together.
     := return: None, since we are simply extracting data from the LIDC-IDR dataset images.
     """
 
     # Add Restrictions to the Script Execution
     if Lidc_IdrFilesPath is None:
         raise ValueError('A path for the LIDC-IDR dataset was not given!')
-    
+
     if pyradiomicsDcmScriptPath is None:
         raise ValueError('A path for the pyradiomics-dcm.py script was not given!')
-    
+
     if pyradiomicsParamsFilePath is None:
         raise ValueError('A path for the Pyradiomics_Params.yaml file was not given!')
-    
-    if pyradiomicsFeatureDictFilePath is None:
-        raise ValueError('A path for the featuresDict.tsv file was not given!')
-    
-    if outputDirectoryPath is None:
-        raise ValueError('A Output Directory [used to save the resulting DICOM file] was not given!')
-    
+
     if tempDirectoryPath is None:
         raise ValueError('A Path to the directory used to store intermediate results was not given!')
 
     if not os.path.isabs(Lidc_IdrFilesPath):
         raise ValueError('The path for the LIDC-IDR dataset is relative! Make sure to use a global path')
 
-    # Save the Initial working directory
-    initialDirectoryPath = os.getcwd()
+    if volumeReconstructor not in ["plastimatch", "dcm2niix"]:
+        raise ValueError('Invalid Volume Reconstructor Introduced!')
 
     # Setting default parameters
-    startPatient = 0 if startPatient is not None else startPatient
-    startPatient = 0 if startPatient is not None else startPatient
+    startPatient = 0 if startPatient is None else startPatient
+    numWorkers = os.cpu_count() if numWorkers is None else numWorkers
 
-    # Switch to the path with the LIDC-IDR dataset
-    os.chdir(Lidc_IdrFilesPath)
-    main_directory = os.listdir()
+    # Resolve the temp directory against the dataset path [As when the extraction ran from inside the LIDC-IDR directory]
+    tempDirectoryPath = os.path.join(Lidc_IdrFilesPath, tempDirectoryPath)
 
-    # Iterate through all the Patients
-    for patient in main_directory:
-        # Skip the output and temp directories alonsgside all the unnecessary patient files (according to the initial patient) and other non-directory files
-        if (not os.path.isdir(patient)) or patient == "OutputSR" or patient == "TempDir" or startPatient > int(patient[len(patient)-4:]):
-            continue
-        
-        # Get the current Patient's Data Folder (Contains the CT-Scan and X-Ray)
-        patientFolders = os.listdir(patient)
-        path = ""
-        content = 0
-        
-        # Finding the CT-scan folder (has the most content - directories with each segmentation and directory with the input DICOM series)
-        for folder in patientFolders:
-            segmentations_or_series = os.listdir(patient + "\\" + folder)
-            if (len(segmentations_or_series) > content):
-                content = len(segmentations_or_series)
-                path = folder
-        
-        # Save the Directory with the Patient's Scans
-        patientScansFolder = os.listdir(patient + "\\" + path)
-        main = ""
+    # Define the output files [The manifest holds the series that were already processed]
+    featuresDirectoryPath = os.path.join(tempDirectoryPath, 'Features')
+    os.makedirs(featuresDirectoryPath, exist_ok=True)
+    featuresFileName = os.path.join(featuresDirectoryPath, 'pyradiomics_features.csv')
+    manifestFileName = os.path.join(tempDirectoryPath, 'pyradiomics_manifest.jsonl')
 
-        # Finding the series folder
-        for folder in patientScansFolder:
-            if not "Annotation" in folder:
-                main = folder
-                break
-        
-        # Create a index to track the current segmentation
-        seg_index = 1
-        
-        # Iterate through all the segmentations and extract their features into a new entry on the .csv output file [Identified with <Patient_Name>-<Segmentation_Number> nomenclature]
-        for folder in patientScansFolder:
-            if "Segmentation" in folder:
-                print("\n\nPACIENT [" + patient + "] - SEGMENTATION [" + str(seg_index) + "]")
-                os.system(f'"""python {pyradiomicsDcmScriptPath} --input-image-dir "{patient}\{path}\{main}" --input-seg-file "{patient}\{path}\{folder}\\1-1.dcm" --output-dir {outputDirectoryPath} --temp-dir {tempDirectoryPath} --parameters {pyradiomicsParamsFilePath} --features-dict {pyradiomicsFeatureDictFilePath} --name {patient}-{seg_index}"""')
-                seg_index+=1
-    
-    # Go back to the initial directory
-    os.chdir(initialDirectoryPath)
\ No newline at end of file
+    # Load the manifest and skip the series already processed
+    processedSeries, featuresSize = loadPyradiomicsManifest(manifestFileName)
+    jobs = [job for job in findPatientSeries(Lidc_IdrFilesPath, startPatient) if job[1] not in processedSeries]
+
+    # Terminate the last line of the manifest if it was left incomplete by an interrupted run
+    if os.path.exists(manifestFileName) and os.path.getsize(manifestFileName) > 0:
+        with open(manifestFileName, 'rb+') as file:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                file.write(b'\n')
+
+    if featuresSize is None:
+        # Record the current size of the features file as the starting point of the extraction
+        _recordPyradiomicsBatch(manifestFileName, [], featuresFileName)
+    elif os.path.exists(featuresFileName) and os.path.getsize(featuresFileName) > featuresSize:
+        # Remove the rows merged by a batch that was interrupted before being recorded, so they are not duplicated when it is processed again
+        with open(featuresFileName, 'rb+') as file:
+            file.truncate(featuresSize)
+
+    # Load the pyradiomics-dcm.py module [Its extraction API is used to compute the features]
+    pyradiomicsDcm = loadPyradiomicsDcmModule(pyradiomicsDcmScriptPath)
+
+    # Process the series in batches [The worker processes are created once and reused by the conversion and extraction of every batch]
+    with ProcessPoolExecutor(max_workers=numWorkers, initializer=_initializeWorker, initargs=(pyradiomicsDcmScriptPath, pyradiomicsParamsFilePath)) as pool:
+        for start in range(0, len(jobs), batchSize):
+            batch = jobs[start:start + batchSize]
+
+            # Convert the series of the batch across the worker processes
+            extractionJobs = []
+            for seriesJobs in pool.map(_convertSeriesWorker, batch, [tempDirectoryPath]*len(batch), [volumeReconstructor]*len(batch)):
+                extractionJobs += seriesJobs
+
+            # Extract the features of all the segments [Appended to the .csv file in the series order]
+            pyradiomicsDcm.extractFeatures(extractionJobs, featuresFileName, pool=pool)
+
+            # Record the processed series of the batch in the manifest
+            _recordPyradiomicsBatch(manifestFileName, batch, featuresFileName)
+
+            # Remove the intermediate files of the batch
+            for job in batch:
+                shutil.rmtree(_seriesTempDirectoryPath(tempDirectoryPath, job[0]), ignore_errors=True)
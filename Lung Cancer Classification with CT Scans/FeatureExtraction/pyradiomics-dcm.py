@@ -1,7 +1,6 @@
 import argparse
 import csv
 from decimal import Decimal
-import distutils.spawn
 import glob
 import json
 import logging
@@ -10,6 +9,7 @@ import shutil
 from subprocess import call
 import sys
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy
 import pandas
@@ -317,6 +317,104 @@ class TID1500Metadata:
       json.dump(self.m, f, indent=2, sort_keys=True)
 
 
+# Extraction API: computes the features of many (name, image, mask, label)
+# jobs. Each worker process initializes the feature extractor once (a pool
+# initialized with initializeWorker can be reused across calls) and returns
+# the features of its jobs, which are appended to the CSV file in job order.
+
+def createExtractor(parameters=None, geometryTolerance=1e-6, correctMask=False):
+  extractionSettings = {
+    "geometryTolerance": float(geometryTolerance),
+    "correctMask": True if correctMask else False
+  }
+  params = []
+  if parameters is not None:
+    params = [parameters]
+  return featureextractor.RadiomicsFeatureExtractor(*params, **extractionSettings)
+
+
+_workerExtractor = None
+_workerSettings = None
+
+
+def initializeWorker(parameters=None, geometryTolerance=1e-6, correctMask=False):
+  global _workerExtractor, _workerSettings
+  settings = (parameters, geometryTolerance, correctMask)
+  if _workerSettings != settings:
+    _workerExtractor = createExtractor(parameters, geometryTolerance, correctMask)
+    _workerSettings = settings
+
+
+def _extractJob(job):
+  name, inputImage, inputMask, label = job
+  try:
+    featureVector = _workerExtractor.execute(inputImage, inputMask, label)
+  except ValueError:
+    scriptlogger.warning("Skipped %s (label %s)", name, label)
+    return None
+
+  if len(featureVector) == 0:
+    scriptlogger.error("No features extracted for %s!", name)
+    return None
+
+  return name, featureVector
+
+
+def _writeFeatureRows(results, featuresFileName):
+  # the file headers are those of the first job (as when extracting in sequence)
+  exists = os.path.exists(featuresFileName) and os.path.getsize(featuresFileName) > 0
+  fileHeaders = None
+  if exists:
+    with open(featuresFileName, 'r') as f:
+      fileHeaders = next(csv.reader(f))[1:]
+
+  count = 0
+  with open(featuresFileName, 'a' if exists else 'w') as f:
+    writer = csv.writer(f, lineterminator='\n')
+    for result in results:
+      if result is None:
+        continue
+      name, featureVector = result
+      if fileHeaders is None:
+        fileHeaders = list(featureVector.keys())
+        writer.writerow(['annotation_id'] + fileHeaders)
+      writer.writerow([name] + [featureVector.get(h, "") for h in fileHeaders])
+      count += 1
+  return count
+
+
+def extractFeatures(jobs, featuresFileName, parameters=None, numWorkers=None,
+                    geometryTolerance=1e-6, correctMask=False, pool=None):
+  """
+  Extract the features of each (name, image, mask, label) job and append
+  one row per job (in job order) to the features CSV file. Jobs that fail
+  are skipped. Returns the number of rows written.
+
+  When a pool is given, its workers must have been initialized with
+  initializeWorker (the extraction settings given here are then unused),
+  so the same pool can be reused across calls.
+  """
+  jobs = list(jobs)
+  if len(jobs) == 0:
+    return 0
+
+  featuresDir = os.path.dirname(os.path.abspath(featuresFileName))
+  if not os.path.isdir(featuresDir):
+    os.makedirs(featuresDir)
+
+  initargs = (parameters, geometryTolerance, correctMask)
+  numWorkers = os.cpu_count() if numWorkers is None else numWorkers
+  if pool is not None:
+    return _writeFeatureRows(pool.map(_extractJob, jobs), featuresFileName)
+  if numWorkers == 1:
+    initializeWorker(*initargs)
+    return _writeFeatureRows(map(_extractJob, jobs), featuresFileName)
+  with ProcessPoolExecutor(max_workers=min(numWorkers, len(jobs)),
+                           initializer=initializeWorker,
+                           initargs=initargs) as pool:
+    return _writeFeatureRows(pool.map(_extractJob, jobs), featuresFileName)
+
+
 def main():
   parser = argparse.ArgumentParser(
     usage="""%(prog)s --input-image <dir> --input-seg <name> --output-sr <name>\n\n
@@ -456,49 +554,47 @@ Support for DICOM Radiotherapy Structure Sets for defining region of interest ma
 
   pyradiomicsVersion = None
 
+  try:
+    scriptlogger.debug("Initializing extractor")
+    extractor = createExtractor(args.parameters, args.geometryTolerance, args.correctMask)
+
+  except Exception:
+    scriptlogger.error(
+      'Initialization of the pyradimics feature extraction failed.', exc_info=True)
+    return -1
+
+  # edits - b
+  featuresFileName = os.path.join(featuresDir, 'pyradiomics_features.csv')
+  scriptlogger.debug("Will save features as %s", featuresFileName)
+  featuresFile = None
+
   for inputSegment in inputSegments:
     scriptlogger.debug("Processing segmentation file %s", inputSegment)
     segmentNumber = os.path.split(inputSegment)[-1].split('.')[0]
 
-    try:
-      scriptlogger.debug("Initializing extractor")
-      extractionSettings = {
-        "geometryTolerance": float(args.geometryTolerance),
-        "correctMask": True if args.correctMask else False
-      }
-      params = []
-      if args.parameters is not None:
-        params = [args.parameters]
-      extractor = featureextractor.RadiomicsFeatureExtractor(*params, **extractionSettings)
-
-    except Exception:
-      scriptlogger.error(
-        'Initialization of the pyradimics feature extraction failed.', exc_info=True)
-      return -1
-
-
     # edits - b
     try:
       featureVector = extractor.execute(inputImage, inputSegment, int(segmentNumber))
     except ValueError:
       print("\n--- SKIPPED ---")
+      if featuresFile is not None:
+        featuresFile.close()
       return 42
 
     if len(featureVector) == 0:
       scriptlogger.error("No features extracted!")
+      if featuresFile is not None:
+        featuresFile.close()
       return -1
 
     # edits - b
-    featuresFileName = os.path.join(featuresDir, 'pyradiomics_features.csv')
-    scriptlogger.debug("Will save features as %s", featuresFileName)
     headers = list(featureVector.keys())
-    if not os.path.exists(featuresFileName):
-      with open(featuresFileName, "w") as trash:
-        pass
-      writer = csv.writer(open(featuresFileName, 'w'), lineterminator='\n')
-      writer.writerow(['annotation_id'] + headers)
-    else:
-      writer = csv.writer(open(featuresFileName, 'a'), lineterminator='\n')
+    if featuresFile is None:
+      exists = os.path.exists(featuresFileName)
+      featuresFile = open(featuresFileName, 'a' if exists else 'w')
+      writer = csv.writer(featuresFile, lineterminator='\n')
+      if not exists:
+        writer.writerow(['annotation_id'] + headers)
     row = [args.patientname]
     for h in headers:
       row.append(featureVector.get(h, ""))
@@ -567,6 +663,9 @@ Support for DICOM Radiotherapy Structure Sets for defining region of interest ma
     m.m["Measurements"][-1]["measurementAlgorithmIdentification"]["AlgorithmVersion"] = pyradiomicsVersion
     m.m["Measurements"][-1]["measurementAlgorithmIdentification"]["AlgorithmParameters"] = [json.dumps(extractor.settings)]
 
+  if featuresFile is not None:
+    featuresFile.close()
+
   m.m["observerContext"] = {}
   m.m["observerContext"]["ObserverType"] = "DEVICE"
   m.m["observerContext"]["DeviceObserverName"] = "pyradiomics"
@@ -603,7 +702,7 @@ Support for DICOM Radiotherapy Structure Sets for defining region of interest ma
 if __name__ == "__main__":
   exeFound = {}
   for exe in ['tid1500writer', 'dcm2niix', 'plastimatch', 'segimage2itkimage']:
-    if distutils.spawn.find_executable(exe) is None:
+    if shutil.which(exe) is None:
       exeFound[exe] = False
     else:
       exeFound[exe] = True
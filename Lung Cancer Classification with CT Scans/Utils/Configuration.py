@@ -7,6 +7,7 @@ def loadConfig() -> dict:
     """
     return {
         'pylidcFeaturesFilename':'./Datasets/pylidc_features.csv',
+        'pylidcCheckpointFilename':'./Datasets/pylidc_features_checkpoint.jsonl',
         'multiClassPylidcFeaturesFilename':'./Datasets/multi_class_pylidc_features.csv',
         'binaryPylidcFeaturesFilename':'./Datasets/binary_pylidc_features.csv',
         'pyradiomicsFeaturesFilename':'./Datasets/pyradiomics_features.csv',
@@ -3,19 +3,18 @@ import sqlalchemy as sq
 from sqlalchemy.orm import relationship
 from ._Base import Base
 from .Scan import Scan
+from .geometry import annotation_geometry, annotation_diameters, annotation_volumes, \
+                      scan_slice_zvals
+from .surface_area import marching_cubes_area
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-# For contour to boolean mask function.
-import matplotlib.path as mplpath
-
 # For CT volume visualizer.
 from matplotlib.patches import Rectangle
 from matplotlib.widgets import Slider, Button, CheckButtons
 
 # For diameter estimation.
-from scipy.spatial.distance import pdist,squareform
 from scipy.interpolate import RegularGridInterpolator
 
 # For 3D visualizer.
@@ -48,6 +47,16 @@ _off_limits = ['id','scan_id','_nodule_id','scan'] + \
 
 viz3dbackends = ['matplotlib', 'mayavi']
 
+def _wrap_index(index, n):
+    """
+    Wrap negative indices into an axis of length `n` and check bounds, as
+    numpy indexing does.
+    """
+    index = np.where(index < 0, index + n, index)
+    if np.any((index < 0) | (index >= n)):
+        raise IndexError("index out of bounds for axis with size %d" % n)
+    return index
+
 class Annotation(Base):
     """
     The Nodule model class holds the information from a single physicians 
@@ -193,6 +202,15 @@ class Annotation(Base):
         else:
             super(Annotation,self).__setattr__(name,value)
 
+    @property
+    def geometry(self):
+        """
+        The contours of the annotation parsed into packed arrays, see
+        :class:`pylidc.geometry.AnnotationGeometry`. It is built once per
+        annotation id and shared by the geometric properties below.
+        """
+        return annotation_geometry(self)
+
     ####################################
     # { Begin semantic attribute functions
 
@@ -425,9 +443,9 @@ class Annotation(Base):
                         raise TypeError(msg)
 
         # The index limits for the scan.
-        limits = [(0,511), (0,511), (0,self.scan.slice_zvals.shape[0]-1)]
+        limits = [(0,511), (0,511), (0,scan_slice_zvals(self.scan).shape[0]-1)]
 
-        cmatrix = self.contours_matrix
+        cmatrix = self.geometry.contours_matrix
         imin,jmin,kmin = cmatrix.min(axis=0)
         imax,jmax,kmax = cmatrix.max(axis=0)
 
@@ -590,7 +608,7 @@ class Annotation(Base):
             `centr[i]` is the average index value of all contour index values
             for coordinate axis `i`.
         """
-        return self.contours_matrix.mean(axis=0)
+        return self.geometry.contours_matrix.mean(axis=0)
 
     @property
     def diameter(self):
@@ -605,28 +623,14 @@ class Annotation(Base):
         diam: float
             The maximal diameter as float, accounting for the axial-plane 
             resolution of the scan. The units are mm.
-        """
-        greatest_diameter = -np.inf
-        i,j,k = 0,0,1 # placeholders for max indices
-        for c,contour in enumerate(self.contours):
-            contour_array = contour.to_matrix()[:,:2]*self.scan.pixel_spacing
-
-            # There's some edge cases where the contour consists only of 
-            # a single point, which we must ignore.
-            if contour_array.shape[0]==1: continue
-            
-            # pdist computes the pairwise distances between the points.
-            # squareform turns the condensed array into matrix where
-            # entry i,j is ||point_i - point_j||.
-            diameters = squareform(pdist(contour_array))
-            diameter  = diameters.max()
 
-            if diameter > greatest_diameter:
-                greatest_diameter = diameter
-                i = c
-                j,k = np.unravel_index(diameters.argmax(), diameters.shape)
-
-        return greatest_diameter
+        Note
+        ----
+        The diameter of each contour is found with rotating calipers on
+        its convex hull (see `geometry.contour_diameters`). Use
+        `geometry.annotation_diameters` for a list of annotations.
+        """
+        return annotation_diameters([self])[0]
 
     @property
     def surface_area(self):
@@ -638,15 +642,17 @@ class Annotation(Base):
         ------
         sa: float
             The estimated surface area in squared millimeters.
-        """
-        mask = self.boolean_mask()
-        mask = np.pad(mask, [(1,1), (1,1), (1,1)], 'constant') # Cap the ends.
-        mask = mask.astype(float)
 
+        Note
+        ----
+        The mesh is built from the boolean mask directly (see
+        `surface_area.marching_cubes_area`). Use
+        `surface_area.annotation_surface_areas` for a list of annotations,
+        optionally with the cheaper voxel face counting approximation.
+        """
         rij  = self.scan.pixel_spacing
         rk   = self.scan.slice_thickness
-        verts, faces, _, _ = marching_cubes(mask, 0.5, spacing=(rij, rij, rk))
-        return mesh_surface_area(verts, faces)
+        return marching_cubes_area(self.boolean_mask(), (rij, rij, rk))
 
     @property
     def volume(self):
@@ -673,35 +679,12 @@ class Annotation(Base):
         vol: float
             The estimated 3D volume of the annotated nodule. Units are cubic
             millimeters.
-        """
-        volume = 0.
-        zvals  = np.unique([c.image_z_position for c in self.contours])
-
-        # We pad a zval on the bottom that is the same distance from the
-        # first zval to the second zval but below the first point. We do 
-        # the same thing for the top zval.
-        if len(self.contours) != 1:
-            zlow  = zvals[ 0] - (zvals[1]-zvals[0])
-            zhigh = zvals[-1] + (zvals[-1]-zvals[-2])
-            zvals = np.r_[zlow, zvals, zhigh]
-        else:
-            zvals = None
-
-        for i,contour in enumerate(self.contours):
-            contour_array = contour.to_matrix() * self.scan.pixel_spacing
-            x = contour_array[:,0]
-            y = contour_array[:,1]
-            # "Shoelace" formula for area.
-            area = 0.5*np.abs(np.dot(x,np.roll(y,1))-np.dot(y,np.roll(x,1)))
-            
-            if zvals is not None:
-                j = np.argmin(np.abs(contour.image_z_position-zvals))
-                spacing_z = 0.5*(zvals[j+1]-zvals[j-1])
-            else:
-                spacing_z = self.scan.slice_thickness
 
-            volume += (1. if contour.inclusion else -1.) * area * spacing_z
-        return volume
+        Note
+        ----
+        Use `geometry.annotation_volumes` for a list of annotations.
+        """
+        return annotation_volumes([self])[0]
 
     def visualize_in_3d(self, edgecolor='0.2', cmap='viridis',
                         step=1, figsize=(5,5), backend='matplotlib'):
@@ -941,7 +924,7 @@ class Annotation(Base):
     @property
     def contour_slice_zvals(self):
         """An array of unique z-coordinates for the contours."""
-        return np.sort([c.image_z_position for c in self.contours])        
+        return np.sort(self.geometry.zvals)
 
     @property
     def contour_slice_indices(self):
@@ -961,16 +944,14 @@ class Annotation(Base):
                 # the two z values should the same (up to machine precision)
                 print(k, z, scan_zvals[k]) 
         """
-        return np.sort([c.image_k_position for c in self.contours])
+        return np.sort(self.geometry.kvals)
 
     @property
     def contours_matrix(self):
         """
         All the contour index values a 3D numpy array.
         """
-        return np.vstack([c.to_matrix(include_k=True)
-                                for c in sorted(self.contours,
-                                        key=lambda c: c.image_z_position)])
+        return self.geometry.contours_matrix.copy()
 
     def boolean_mask(self, pad=None, bbox=None, include_contour_points=False):
         """
@@ -1016,69 +997,52 @@ class Annotation(Base):
         czs = self.contour_slice_zvals
         cks = self.contour_slice_indices
 
-        zs = self.scan.slice_zvals
-        zs = zs[cks[0]:cks[-1]+1]
-
-        # Lambda to map a z-value to its appropriate index in the volume.
-        z_to_index = lambda z: dict(zip(czs,cks))[z] - bb[2,0]#cks[0]
+        # Map the z-value of each contour to its index in the volume.
+        z_to_k = dict(zip(czs,cks))
+        geometry = self.geometry
 
         # Get dimensions, initialize mask.
         ni,nj,nk = np.diff(bb, axis=1).astype(int)[:,0] + 1
-        mask = np.zeros((ni,nj,nk), dtype=bool)
-
-        # We check if these points are enclosed within each contour 
-        # for a given slice. `test_points` is a list of image coordinate 
-        # points, offset by the bounding box.
-        ii,jj = np.indices(mask.shape[:2])
-        test_points = bb[:2,0] + np.c_[ii.flatten(), jj.flatten()]
-
-        # First we "turn on" pixels enclosed by inclusion contours.
-        for contour in self.contours:
-            if contour.inclusion:
-                zi = z_to_index(contour.image_z_position)
-                C  = contour.to_matrix(include_k=False)
-
-                # Turn the contour closed if it is not.
-                if (C[0] != C[-1]).any():
-                    C = np.append(C, C[0].reshape(1,2), axis=0)
-
-                # Create path object and test all pixels
-                # within the contour's bounding box.
-                path = mplpath.Path(C, closed=True)
-                contains_pts = path.contains_points(test_points)
-                contains_pts = contains_pts.reshape(mask.shape[:2])
-
-                # The logical or here prevents the cases where a single
-                # slice contains multiple inclusion regions.
-                mask[:,:,zi] = np.logical_or(mask[:,:,zi], contains_pts)
-
-                if not include_contour_points:
-                    # Remove the contour points themselves.
-                    i, j = (C - bb[:2,0]).T
-                    k = np.ones(C.shape[0], dtype=int)*zi
-                    mask[i,j,k] = False
-
-        # Second, we "turn off" pixels enclosed by exclusion contours.
-        for contour in self.contours:
-            if not contour.inclusion:
-                zi = z_to_index(contour.image_z_position)
-                C = contour.to_matrix(include_k=False)
-
-                # Turn the contour closed if it is not.
-                if (C[0] != C[-1]).any():
-                    C = np.append(C, C[0].reshape(1,2), axis=0)
-
-                path = mplpath.Path(C, closed=True)
-                not_contains_pts = ~path.contains_points(test_points)
-                not_contains_pts = not_contains_pts.reshape(mask.shape[:2])
-                mask[:,:,zi] = np.logical_and(mask[:,:,zi], not_contains_pts)
-
-                # Remove the contour points themselves.
-                i, j = (C - bb[:2,0]).T
-                k = np.ones(C.shape[0], dtype=int)*zi
-                mask[i,j,k] = False
-
-        return mask
+        zi = np.array([_wrap_index(z_to_k[z] - bb[2,0], nk)
+                       for z in geometry.zvals], dtype=np.int64)
+
+        # The pixels enclosed by each contour (see `geometry.fill_polygons`),
+        # restricted to the bounding box, as flat indices into the mask.
+        fc, fi, fj = geometry.fills
+        fi = fi - bb[0,0]
+        fj = fj - bb[1,0]
+        inbox = (fi >= 0) & (fi < ni) & (fj >= 0) & (fj < nj)
+        fc, fi, fj = fc[inbox], fi[inbox], fj[inbox]
+        fills = (fi*nj + fj)*nk + zi[fc]
+
+        # The contour points themselves, as flat indices into the mask.
+        pc = np.repeat(np.arange(len(geometry)), geometry.sizes)
+        points = np.ravel_multi_index(
+            (_wrap_index(geometry.points[:,0] - bb[0,0], ni),
+             _wrap_index(geometry.points[:,1] - bb[1,0], nj),
+             zi[pc]), (ni,nj,nk))
+
+        # First we "turn on" pixels enclosed by inclusion contours, each
+        # contour (in order) setting its interior and then, optionally,
+        # clearing its points. The value of a voxel is thus set by the
+        # last contour event touching it: contour c has rank 2c+1 for
+        # its interior and 2c+2 for its points.
+        fill_rank  = np.zeros(ni*nj*nk, dtype=np.int64)
+        clear_rank = np.zeros(ni*nj*nk, dtype=np.int64)
+
+        incl = geometry.inclusion[fc]
+        np.maximum.at(fill_rank, fills[incl], 2*fc[incl]+1)
+        if not include_contour_points:
+            incl = geometry.inclusion[pc]
+            np.maximum.at(clear_rank, points[incl], 2*pc[incl]+2)
+        mask = fill_rank > clear_rank
+
+        # Second, we "turn off" pixels enclosed by exclusion contours,
+        # and the exclusion contour points themselves.
+        mask[fills[~geometry.inclusion[fc]]] = False
+        mask[points[~geometry.inclusion[pc]]] = False
+
+        return mask.reshape(ni,nj,nk)
 
     def _as_set(self):
         """
@@ -1087,45 +1051,13 @@ class Annotation(Base):
         3-tuple referring to a voxel within the scan. If the voxel is 
         in the set, the nodule is considered to be defined there.
         
-        Essentially this is a boolean mask stored as a set.
+        Essentially this is a boolean mask stored as a set. Overlaps are
+        now computed on the mask itself, see `AnnotationGeometry.voxels`.
         """
-        included = set()
-        excluded = set()
-        # Add all points lying within each inclusion contour to S.
-        for contour in self.contours:
-            contour_matrix = contour.to_matrix()[:,:2]
-            # Turn the contour closed if it's not.
-            if (contour_matrix[0] != contour_matrix[-1]).all():
-                contour_matrix = np.append(contour_matrix,
-                                           contour_matrix[0].reshape(1,2),
-                                           axis=0)
-
-            # Create path object and test all pixels 
-            # within the contour's bounding box.
-            path = mplpath.Path(contour_matrix, closed=True)
-            mn = contour_matrix.min(axis=0)
-            mx = contour_matrix.max(axis=0)
-            x,y = np.mgrid[mn[0]:mx[0]+1, mn[1]:mx[1]+1]
-            test_points = np.c_[x.flatten(), y.flatten()]
-            points_in_contour = test_points[path.contains_points(test_points)]
-
-            # Add the z coordinate.
-            points_in_contour = np.c_[\
-                points_in_contour,\
-                np.ones(points_in_contour.shape[0])*contour.image_z_position
-            ]
-
-            # Now turn the numpy matrix into a list of tuples,
-            # so we can add it to the corresponding set.
-            points_in_contour = list(map(tuple, points_in_contour))
-
-            # Update the corresponding set.
-            if contour.inclusion:
-                included.update(points_in_contour)
-            else:
-                excluded.update(points_in_contour)
-        # Return the included points minus the excluded points.
-        return included.difference( excluded )
+        origin, zvals, mask, _ = self.geometry.voxels
+        i, j, k = np.nonzero(mask)
+        points = np.c_[i + origin[0], j + origin[1], zvals[k]]
+        return set(map(tuple, points))
 
     def uniform_cubic_resample(self, side_length=None, resample_vol=True,
                                irp_pts=None, return_irp_pts=False,
@@ -1143,6 +1075,12 @@ class Annotation(Base):
         interpolation, i.e., not necessarily uniform spacing and allowing 
         different resample-resolutions along different coordinate axes.
 
+        Note
+        ----
+        To resample several annotations of the same scan, see
+        `resample.resample_annotations`, which reads the scan volume once
+        and interpolates it separably instead of over a meshgrid.
+
         Parameters
         ----------
         side_length: integer, default=None
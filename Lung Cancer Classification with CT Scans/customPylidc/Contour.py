@@ -4,6 +4,7 @@ import numpy as np
 from ._Base import Base
 from .Scan import Scan
 from .Annotation import Annotation
+from .geometry import scan_slice_zvals
 
 _off_limits = ['id','annotation_id','annotation',
                'inclusion','image_z_position','dicom_file_name','coords']
@@ -85,7 +86,7 @@ class Contour(Base):
         This index may not be unique if the `slice_zvals` of the respective
         scan are not unique.
         """
-        zs = self.annotation.scan.slice_zvals
+        zs = scan_slice_zvals(self.annotation.scan)
         k = np.abs(zs-self.image_z_position).argmin()
         return k
 
@@ -107,7 +108,6 @@ class Contour(Base):
             return ij
         else:
             k  = np.ones(ij.shape[0])*self.image_k_position
-            zs = self.annotation.contour_slice_zvals
             return np.c_[ij, k].astype(int)
     
 Annotation.contours = relationship('Contour',
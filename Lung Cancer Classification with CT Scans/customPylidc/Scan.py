@@ -1,6 +1,7 @@
 import os
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import pydicom as dicom
 import numpy as np
@@ -12,7 +13,9 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider
 
 from scipy.sparse.csgraph import connected_components
-from .annotation_distance_metrics import metrics
+from .annotation_distance_metrics import metrics, distance_matrix
+from .dicom_index import SeriesIndex
+from .volume_cache import VolumeCache, fill_volume
 
 
 try:
@@ -79,6 +82,155 @@ def _get_dicom_file_path_from_config_file():
         return parser.get(section='dicom', option='path')
 
 
+def _get_cache_path_from_config_file():
+    """
+    Loads the optional `path` option of the `cache` section of the 
+    configuration file. This is the directory where the DICOM series 
+    index (and other on-disk caches) are stored. It defaults to 
+    `.pylidc_cache` next to the configuration file.
+    """
+    parser = SafeConfigParser()
+
+    conf_file = _get_config_file()
+    if os.path.exists(conf_file):
+        parser.read(conf_file)
+
+    try:
+        path = parser.get(section='cache', option='path')
+    except (configparser.NoSectionError,
+            configparser.NoOptionError):
+        path = ''
+
+    return path or os.path.join(_get_config_path(), '.pylidc_cache')
+
+
+_series_index = None
+
+def _get_series_index():
+    """
+    Yields the (lazily loaded) DICOM series index shared by all scans.
+    """
+    global _series_index
+    if _series_index is None:
+        fname = os.path.join(_get_cache_path_from_config_file(),
+                             'dicom_series_index.json')
+        _series_index = SeriesIndex(fname)
+    return _series_index
+
+
+_volume_cache = None
+
+def _get_volume_cache():
+    """
+    Yields the on-disk CT volume cache shared by all scans.
+    """
+    global _volume_cache
+    if _volume_cache is None:
+        directory = os.path.join(_get_cache_path_from_config_file(),
+                                 'volumes')
+        _volume_cache = VolumeCache(directory)
+    return _volume_cache
+
+
+def index_dicom_files(root=None, verbose=True):
+    """
+    Index every DICOM series found under the dataset root so that later 
+    calls to `Scan.get_path_to_dicom_files` are answered from the 
+    on-disk index instead of walking the patient folders.
+
+    Parameters
+    ----------
+    root: string, default=None
+        The dataset root. If None, the `path` option of the `dicom` section 
+        of the configuration file is used.
+
+    verbose: bool, default=True
+        Print each directory as it is indexed.
+
+    Return
+    ------
+    n: int
+        The number of directories that were (re)indexed. Directories whose
+        index entry is still valid are skipped.
+
+    Example
+    -------
+    Index the whole dataset once, e.g., before a feature extraction run::
+
+        import pylidc as pl
+
+        pl.index_dicom_files()
+    """
+    root = _get_dicom_file_path_from_config_file() if root is None else root
+
+    if not os.path.exists(root):
+        msg = "Could not find the DICOM dataset root {}."
+        raise RuntimeError(msg.format(root))
+
+    index = _get_series_index()
+    n = index.index_tree(root, verbose=verbose)
+    index.save()
+    return n
+
+
+_slice_header_tags = ['SeriesInstanceUID', 'StudyInstanceUID',
+                      'ImagePositionPatient', 'InstanceNumber']
+
+def _read_slice_header(fname):
+    """
+    Read the (series uid, study uid, z, instance number) of a DICOM
+    slice, without reading its pixel data. The values of the tags that
+    the file does not have (e.g., a DICOMDIR, SR or SEG object) are None.
+    """
+    image = dicom.dcmread(fname, stop_before_pixels=True,
+                          specific_tags=_slice_header_tags)
+    seid  = getattr(image, 'SeriesInstanceUID', None)
+    stid  = getattr(image, 'StudyInstanceUID', None)
+    ipp   = getattr(image, 'ImagePositionPatient', None)
+    inum  = getattr(image, 'InstanceNumber', None)
+    return (None if seid is None else str(seid).strip(),
+            None if stid is None else str(stid).strip(),
+            None if ipp  is None else float(ipp[-1]),
+            None if inum is None else float(inum))
+
+
+def _unique_slice_order(zs, inums):
+    """
+    Return the indices of the slices to keep, sorted by increasing `z`.
+    When several slices share the same `z` value, only the one with the
+    lesser instance number is kept (the first one, in case of ties).
+
+    Parameters
+    ----------
+    zs: list or ndarray of floats
+        The `z` coordinate (ImagePositionPatient) of each slice.
+
+    inums: list or ndarray of floats
+        The InstanceNumber of each slice.
+    """
+    zs    = np.asarray(zs, dtype=float)
+    inums = np.asarray(inums, dtype=float)
+
+    # Sort by z, then by instance number. `lexsort` is stable, so slices
+    # with the same (z, instance number) keep their original order.
+    order = np.lexsort((inums, zs))
+
+    # Keep the first slice of each run of equal z values.
+    zs_sorted = zs[order]
+    first = np.ones(order.shape[0], dtype=bool)
+    first[1:] = zs_sorted[1:] != zs_sorted[:-1]
+    return order[first]
+
+
+def _read_slice(fname):
+    """
+    Read a full DICOM slice and decode its pixel data.
+    """
+    image = dicom.dcmread(fname)
+    image.pixel_array
+    return image
+
+
 _off_limits = ['id','study_instance_uid','series_instance_uid',
                'patient_id','slice_thickness','pixel_spacing',
                'contrast_used','is_from_initial','sorted_dicom_file_names']
@@ -202,13 +354,17 @@ class Scan(Base):
            where "???" is some unknown folder hierarchy convention used
            by TCIA.
 
-        We first check option 1. Otherwise, we check if the
-        "LIDC-IDRI-dddd" folder exists in the root path. If so, then we 
-        recursively search the "LIDC-IDRI-dddd" directory until we find
-        the correct subfolder that contains a DICOM file with the correct
-        `study_instance_uid` and `series_instance_uid`.
+        We first check option 1. Otherwise, we check the on-disk series 
+        index (see `pylidc.index_dicom_files`). If the series is not 
+        indexed, we check if the "LIDC-IDRI-dddd" folder exists in the root 
+        path. If so, then we recursively search the "LIDC-IDRI-dddd" 
+        directory, reading only the DICOM headers, and record every series 
+        found in the index. The correct subfolder is the one that contains 
+        a DICOM file with the correct `study_instance_uid` and 
+        `series_instance_uid`.
 
         Option 2 is less efficient than 1; however, option 2 is robust.
+        Thanks to the index, the search is performed only once per series.
         """
         dicompath = _get_dicom_file_path_from_config_file()
 
@@ -228,48 +384,43 @@ class Scan(Base):
                             self.study_instance_uid,
                             self.series_instance_uid)
 
-        # Check if old path first. If not found, do recursive search.
+        # Check if old path first. If not found, check the index and
+        # fall back to a recursive search that updates the index.
         if not os.path.exists(path): # and base exists
-            found = False
-            for dpath,dnames,fnames in os.walk(base):
-                # Skip if no files in current dir.
-                if len(fnames) == 0: continue
-
-                # Gather up DICOM files in dir (if any).
-                dicom_file = [d for d in fnames if d.endswith(".dcm") and not d.startswith(".")]
-
-                # Skip if no DICOM files.
-                if len(dicom_file) == 0: continue
-
-                # Grab the first DICOM file in the dir since they should
-                # all have the same series/study ids.
-                dicom_file = dicom_file[0]
-
-                dimage = dicom.dcmread(os.path.join(dpath, dicom_file))
-
-                seid = str(dimage.SeriesInstanceUID).strip()
-                stid = str(dimage.StudyInstanceUID).strip()
+            index = _get_series_index()
+            path  = index.lookup(dicompath, self.series_instance_uid,
+                                 self.study_instance_uid)
 
-                if seid == self.series_instance_uid and \
-                   stid == self.study_instance_uid:
-                    path = dpath
-                    found = True
-                    break
+            if path is None:
+                index.index_tree(dicompath, base=base)
+                index.save()
+                path = index.lookup(dicompath, self.series_instance_uid,
+                                    self.study_instance_uid)
 
-            if not found:
+            if path is None:
                 raise IOError("Couldn't find DICOM files for %s."%self)
 
         return path
 
-    def load_all_dicom_images(self, verbose=True):
+    def load_all_dicom_images(self, verbose=True, n_workers=None):
         """
         Load all the DICOM images assocated with this scan and return as list.
 
+        The files are loaded in two phases. First, only the DICOM headers
+        (up to, but not including, the pixel data) are read to select the
+        files of this series, prune duplicate `z` slices and sort them.
+        Second, the selected files are read in full, and their pixel data
+        decoded, on a pool of threads.
+
         Parameters
         ----------
         verbose: bool
             Turn the loading method on/off.
 
+        n_workers: int, default=None
+            The number of threads used to read the files. If None, the
+            default of `concurrent.futures.ThreadPoolExecutor` is used.
+
         Example
         -------
         An example::
@@ -290,46 +441,37 @@ class Scan(Base):
         if verbose: print("Loading dicom files ... This may take a moment.")
 
         path = self.get_path_to_dicom_files()
-        fnames = [fname for fname in os.listdir(path)
+        fnames = [os.path.join(path, fname) for fname in os.listdir(path)
                             if fname.endswith('.dcm') and not fname.startswith(".")]
-        images = []
-        for fname in fnames:
-            image = dicom.dcmread(os.path.join(path,fname))
-
-            seid = str(image.SeriesInstanceUID).strip()
-            stid = str(image.StudyInstanceUID).strip()
-
-            if seid == self.series_instance_uid and\
-               stid == self.study_instance_uid:
-                images.append(image)
-
-        # ##############################################
-        # Clean multiple z scans.
-        #
-        # Some scans contain multiple slices with the same `z` coordinate 
-        # from the `ImagePositionPatient` tag.
-        # The arbitrary choice to take the slice with lesser 
-        # `InstanceNumber` tag is made.
-        # This takes some work to accomplish...
-        zs    = [float(img.ImagePositionPatient[-1]) for img in images]
-        inums = [float(img.InstanceNumber) for img in images]
-        inds = list(range(len(zs)))
-        while np.unique(zs).shape[0] != len(inds):
-            for i in inds:
-                for j in inds:
-                    if i!=j and zs[i] == zs[j]:
-                        k = i if inums[i] > inums[j] else j
-                        inds.pop(inds.index(k))
-
-        # Prune the duplicates found in the loops above.
-        zs     = [zs[i]     for i in range(len(zs))     if i in inds]
-        images = [images[i] for i in range(len(images)) if i in inds]
-
-        # Sort everything by (now unique) ImagePositionPatient z coordinate.
-        sort_inds = np.argsort(zs)
-        images    = [images[s] for s in sort_inds]
-        # End multiple z clean.
-        # ##############################################
+
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            # Phase 1: headers only.
+            headers = list(pool.map(_read_slice_header, fnames))
+
+            # Keep the slices of this series. Files without a position or
+            # an instance number (e.g., SR or SEG objects) are skipped.
+            keep = [i for i,h in enumerate(headers)
+                    if h[0] == self.series_instance_uid and
+                       h[1] == self.study_instance_uid and
+                       h[2] is not None and h[3] is not None]
+            fnames  = [fnames[i]  for i in keep]
+            headers = [headers[i] for i in keep]
+
+            # ##############################################
+            # Clean multiple z scans.
+            #
+            # Some scans contain multiple slices with the same `z` coordinate 
+            # from the `ImagePositionPatient` tag.
+            # The arbitrary choice to take the slice with lesser 
+            # `InstanceNumber` tag is made.
+            zs    = [h[2] for h in headers]
+            inums = [h[3] for h in headers]
+            fnames = [fnames[i] for i in _unique_slice_order(zs, inums)]
+            # End multiple z clean.
+            # ##############################################
+
+            # Phase 2: read the pixel data of the kept slices only.
+            images = list(pool.map(_read_slice, fnames))
 
         return images
 
@@ -393,6 +535,12 @@ class Scan(Base):
         Annotation groups are determined by finding the connected components 
         of the graph associated with this adjacency matrix.
 
+        When `metric` is a string, the distance matrix is computed once
+        per set of annotations and cached (see
+        `pylidc.annotation_distance_metrics.distance_matrix`), so the
+        retries only re-threshold it and repeated calls are free. Call
+        `pylidc.annotation_distance_metrics.clear_cache()` to drop it.
+
         Example
         -------
         An example::
@@ -419,13 +567,6 @@ class Scan(Base):
             """
             Attempts to cluster annotations with the given tolerance.
             """
-            D = np.zeros((N, N))  # Distance matrix
-
-            # Calculate distances between annotations
-            for i in range(N):
-                for j in range(i+1, N):
-                    D[i, j] = D[j, i] = metric(self.annotations[i], self.annotations[j])
-
             adjacency = D <= tol
             nnods, cids = connected_components(adjacency, directed=False)
             ucids = np.unique(cids)
@@ -433,11 +574,9 @@ class Scan(Base):
 
             return adjacency, nnods, cids, ucids, counts
 
-        # Fetch the metric function if it's a string
-        if isinstance(metric, str):
-            if metric not in metrics.keys():
-                raise ValueError(f"Invalid metric: {metric}. Available metrics are: {list(metrics.keys())}")
-            metric = metrics[metric]
+        # Check the metric if it's a string
+        if isinstance(metric, str) and metric not in metrics.keys():
+            raise ValueError(f"Invalid metric: {metric}. Available metrics are: {list(metrics.keys())}")
 
         N = len(self.annotations)
         tol = self.slice_thickness if tol is None else tol
@@ -449,6 +588,11 @@ class Scan(Base):
         elif N == 1:
             return [[self.annotations[0]]]
 
+        # The distance matrix only depends on the annotations, so it is
+        # computed once (or fetched from the cache) and then only
+        # thresholded with the decreasing tolerances.
+        D = distance_matrix(self.annotations, metric)
+
         # Try clustering with retries
         retries = 0
         while retries < max_retries:
@@ -647,17 +791,59 @@ class Scan(Base):
                          self.pixel_spacing,
                          self.slice_spacing])
 
-    def to_volume(self, verbose=True):
+    def to_volume(self, verbose=True, use_cache=True, n_workers=None,
+                  mmap=False):
         """
         Return the scan as a 3D numpy array volume.
-        """
-        images = self.load_all_dicom_images(verbose=verbose)
 
-        volume = np.stack(
-            [
-                x.pixel_array * x.RescaleSlope + x.RescaleIntercept
-                for x in images
-            ],
-            axis=-1,
-        ).astype(np.int16)
-        return volume
+        Parameters
+        ----------
+        verbose: bool, default=True
+            Turn the loading statement on/off.
+
+        use_cache: bool, default=True
+            If True, the volume is read from (or, on the first call, written
+            to) the on-disk volume cache, which is stored under the `cache`
+            path of the configuration file. The cached volume is rebuilt if
+            the directory of the DICOM files is modified.
+
+        mmap: bool, default=False
+            Only used with `use_cache`. If True, the cached volume is
+            returned as a read-only `np.memmap` instead of being copied
+            into memory, which is faster when only part of the volume is
+            read, but it must be copied before being modified in place.
+
+        n_workers: int, default=None
+            See :meth:`pylidc.Scan.load_all_dicom_images`.
+
+        Note
+        ----
+        The volume is filled one slice at a time into a preallocated int16
+        array, so building it takes little more memory than the volume.
+        """
+        if use_cache:
+            cache = _get_volume_cache()
+            path  = self.get_path_to_dicom_files()
+            mtime = os.stat(path).st_mtime
+
+            volume = cache.load(self.series_instance_uid, source_mtime=mtime)
+            if volume is not None:
+                return volume if mmap else np.array(volume)
+
+        images = self.load_all_dicom_images(verbose=verbose,
+                                            n_workers=n_workers)
+
+        if not use_cache:
+            volume = np.empty(images[0].pixel_array.shape + (len(images),),
+                              dtype=np.int16)
+            return fill_volume(volume, images)
+
+        metadata = {
+            'series_instance_uid': self.series_instance_uid,
+            'source_mtime': mtime,
+            'spacings': [float(s) for s in self.spacings],
+            'slice_zvals': [float(img.ImagePositionPatient[-1])
+                            for img in images],
+        }
+        volume = cache.store(self.series_instance_uid, images, metadata)
+        return volume if mmap else np.array(volume)
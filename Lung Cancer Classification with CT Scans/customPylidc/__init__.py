@@ -25,18 +25,81 @@ __version__ = '0.2.3'
 # Hidden stuff.
 import os as _os
 import pkg_resources as _pr
-from sqlalchemy import create_engine as _create_engine
-from sqlalchemy.orm import sessionmaker as _sessionmaker
+from urllib.parse import quote as _quote
+from sqlalchemy import create_engine as _create_engine, event as _event
+from sqlalchemy.orm import sessionmaker as _sessionmaker, \
+                           scoped_session as _scoped_session
 
 _dbpath  = _pr.resource_filename('pylidc', 'pylidc.sqlite')
-_engine  = _create_engine('sqlite:///'+_dbpath)
-_session = _sessionmaker(bind=_engine)()
+
+# Connection settings for read-heavy access: the database file is memory
+# mapped, each connection keeps a 64MB page cache, and writes are refused.
+_pragmas = {'mmap_size': 2**28, 'cache_size': -2**16, 'query_only': 1}
+
+def session_factory(dbpath=None, read_only=True, pragmas=None):
+    """
+    Create a thread-local session registry on the pylidc database. Each
+    thread (and each forked process) calling it gets its own session,
+    whose connections are drawn from the pool of a single engine.
+
+    Parameters
+    ----------
+    dbpath: str, default=None
+        Path to the sqlite database. The bundled one by default.
+
+    read_only: bool, default=True
+        If True, the database is opened in read-only mode.
+
+    pragmas: dict, default=None
+        The `PRAGMA`s run on each new connection. `_pragmas` by default
+        (without `query_only` when `read_only` is False).
+
+    Return
+    ------
+    session: sqlalchemy.orm.scoped_session
+        Calling it returns the session of the current thread, and the
+        session methods (e.g., `query`) can be called on it directly.
+    """
+    dbpath = _dbpath if dbpath is None else dbpath
+    if pragmas is None:
+        pragmas = dict(_pragmas)
+        if not read_only:
+            pragmas.pop('query_only')
+
+    if read_only:
+        url = 'sqlite:///file:%s?mode=ro&uri=true' % _quote(dbpath)
+    else:
+        url = 'sqlite:///' + dbpath
+    engine = _create_engine(url, connect_args={'check_same_thread': False})
+
+    @_event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name,value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    session = _scoped_session(_sessionmaker(bind=engine))
+
+    # A forked process must not reuse the connections (or the sessions)
+    # of its parent: they are dropped without being closed.
+    def reset():
+        engine.dispose(close=False)
+        session.registry.clear()
+    if hasattr(_os, 'register_at_fork'):
+        _os.register_at_fork(after_in_child=reset)
+
+    return session
+
+_session = session_factory()
+_engine  = _session.get_bind()
 
 # Public stuff.
-from .Scan       import Scan, ClusterError
+from .Scan       import Scan, ClusterError, index_dicom_files
 from .Annotation import Annotation
 from .Contour    import Contour
 from .Zval       import Zval
+from .cohort     import load_cohort
 
 from .Annotation import feature_names as annotation_feature_names
 
@@ -62,5 +125,8 @@ def query(*args):
         ann = anns.first()
         print(ann.volume)
         # => 5230.33874999
+
+    The session is local to the calling thread (see `session_factory`),
+    so threads and worker processes can query concurrently.
     """
     return _session.query(*args)
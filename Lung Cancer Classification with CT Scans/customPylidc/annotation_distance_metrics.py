@@ -1,26 +1,144 @@
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree, ConvexHull, QhullError
+from scipy.spatial.distance import cdist, directed_hausdorff
+from . import geometry
+from .geometry import annotation_geometry, voxel_overlap
 
 metrics = {}
 
+# The KD-trees, convex hull vertices and slice centroids of the contour
+# points of each annotation are stored with its cached geometry (see
+# `AnnotationGeometry.derived`), and the distance matrices of the most
+# recently used sets of annotations here, keyed on annotation ids. All are
+# filled lazily and dropped by `clear_cache`.
+_matrix_cache = geometry.LRUCache(256)
+geometry._dependent_caches.append(_matrix_cache)
+
+# Upper bound on the number of entries of each block of pairwise
+# distances computed by `distance_matrix`.
+_block_size = 2**22
+
+# Pairs of annotations with at most this many pairwise distances are
+# compared with a dense `cdist`, which is faster than a tree or hull
+# for small nodules.
+_dense_size = 2**14
+
+def annotation_points(ann):
+    """
+    Return the (read-only) contour boundary points of the annotation,
+    i.e., `ann.contours_matrix`, as stored in its cached geometry.
+    """
+    return annotation_geometry(ann).contours_matrix
+
+def _cached(name, ann, build):
+    """
+    Return `build(annotation_points(ann))`, cached with the geometry of
+    the annotation.
+    """
+    derived = annotation_geometry(ann).derived
+    value = derived.get(name)
+    if value is None:
+        value = build(annotation_points(ann))
+        derived[name] = value
+    return value
+
+def annotation_tree(ann):
+    """
+    Return a `cKDTree` of the contour boundary points of the annotation,
+    cached with the geometry of the annotation.
+    """
+    return _cached('tree', ann, cKDTree)
+
+def _hull_points(points):
+    """
+    The vertices of the convex hull of the points, computed in the
+    subspace they span (e.g., the slice plane of a single slice nodule).
+    All the points are returned when the hull is degenerate.
+    """
+    dims = np.flatnonzero(np.ptp(points, axis=0) > 0)
+    try:
+        vertices = ConvexHull(points[:,dims]).vertices
+    except (QhullError, ValueError):
+        return points
+    return points[np.sort(vertices)]
+
+def annotation_hull(ann):
+    """
+    Return the contour boundary points of the annotation that are vertices
+    of their convex hull, cached with the geometry of the annotation. The
+    distance to a point is a convex function, so the farthest boundary
+    point is one of them.
+    """
+    return _cached('hull', ann, _hull_points)
+
+def _slice_centroids(points):
+    """
+    The sorted slice indices of the points, and the mean (i,j) of the
+    points of each slice, computed with one grouped reduction.
+    """
+    zvals, inverse, counts = np.unique(points[:,2], return_inverse=True,
+                                       return_counts=True)
+    inverse = inverse.reshape(-1)
+    centroids = np.c_[np.bincount(inverse, points[:,0]),
+                      np.bincount(inverse, points[:,1])] / counts[:,None]
+    zvals.flags.writeable = False
+    centroids.flags.writeable = False
+    return zvals, centroids
+
+def annotation_slice_centroids(ann):
+    """
+    Return the sorted slice indices of the contour boundary points of the
+    annotation and the in-slice centroid of the points of each slice,
+    cached with the geometry of the annotation.
+    """
+    return _cached('slice_centroids', ann, _slice_centroids)
+
+def clear_cache():
+    """
+    Drop the cached geometries, trees, hulls, slice centroids and distance
+    matrices, e.g., after the contours of an annotation were modified.
+    This is the same as `geometry.clear_cache()`.
+    """
+    geometry.clear_cache()
+
+def _mean_pairdist(P1, P2):
+    """
+    The mean pairwise distance between two point sets, computed in row
+    blocks of at most `_block_size` distances.
+    """
+    rows = max(1, _block_size // max(len(P2), 1))
+    if rows >= len(P1):
+        return cdist(P1, P2).mean()
+    total = sum(cdist(P1[i:i+rows], P2).sum()
+                for i in range(0, len(P1), rows))
+    return total / (len(P1)*len(P2))
+
 def pairdist(ann1, ann2, which):
     """
     Compute the pairwise euclidean distance between 
     the contour boundary points, and return the 
     minimum, maximum, or average value.
 
+    The minimum is found with a KD-tree query and the maximum only
+    between the convex hull vertices of each annotation, so neither
+    computes the full distance matrix.
+
     which: str
         One of 'min', 'max', or 'avg'.
     """
-    dists = cdist(ann1.contours_matrix,
-                  ann2.contours_matrix)
+    P1 = annotation_points(ann1)
+    P2 = annotation_points(ann2)
+    if which in ('min', 'max') and len(P1)*len(P2) <= _dense_size:
+        dists = cdist(P1, P2)
+        return dists.min() if which == 'min' else dists.max()
 
     if   which == 'min':
+        dists, _ = annotation_tree(ann2).query(P1)
         return dists.min()
     elif which == 'max':
-        return dists.max()
+        return cdist(annotation_hull(ann1), annotation_hull(ann2)).max()
     elif which == 'avg':
-        return dists.mean()
+        return _mean_pairdist(P1, P2)
     else:
         raise ValueError('invalid `which` value.')
 
@@ -33,7 +151,7 @@ def centroid_xyz(ann1, ann2):
     Compute the euclidean distance between the x,y,z coordinates of
     each annotation's centroid.
     """
-    return np.linalg.norm(ann1.centroid(0) - ann2.centroid(0))
+    return np.linalg.norm(ann1.centroid - ann2.centroid)
 
 metrics['centroid_xyz'] = centroid_xyz
 
@@ -46,22 +164,17 @@ def centroid_xy(ann1, ann2, which):
     which: str
         One of 'min', 'max', or 'avg'.
     """
-    P1 = ann1.contours_matrix
-    P2 = ann2.contours_matrix
+    zvals1, centroids1 = annotation_slice_centroids(ann1)
+    zvals2, centroids2 = annotation_slice_centroids(ann2)
 
-    zvals1 = set(np.unique(P1[:,2]).tolist())
-    zvals2 = set(np.unique(P2[:,2]).tolist())
-    zvals = zvals1.intersection(zvals2)
+    # Join the per-slice centroid tables on the shared z values.
+    _, k1, k2 = np.intersect1d(zvals1, zvals2, assume_unique=True,
+                               return_indices=True)
 
-    if len(zvals) == 0:
+    if len(k1) == 0:
         return centroid_xyz(ann1, ann2)
 
-    dists = np.zeros(len(zvals))
-
-    for i,z in enumerate(zvals):
-        c1 = P1[:,:2][P1[:,2] == z].mean(0)
-        c2 = P2[:,:2][P2[:,2] == z].mean(0) 
-        dists[i] = np.linalg.norm(c1 - c2)
+    dists = np.linalg.norm(centroids1[k1] - centroids2[k2], axis=1)
 
     if   which == 'min':
         return dists.min()
@@ -79,12 +192,18 @@ metrics['centroid_xy_avg'] = lambda a,b: centroid_xy(a,b,'avg')
 def hausdorff(ann1, ann2):
     """
     Compute the Hausdorff distance [1] between the contour boundary points.
+    Each directed distance is computed with the early break algorithm
+    of `scipy.spatial.distance.directed_hausdorff` [2].
 
     [1]: https://en.wikipedia.org/wiki/Hausdorff_distance
+    [2]: https://doi.org/10.1109/TPAMI.2015.2408351
     """
-    C = cdist(ann1.contours_matrix,
-              ann2.contours_matrix)
-    return max(C.min(0).max(), C.min(1).max())
+    P1 = annotation_points(ann1)
+    P2 = annotation_points(ann2)
+    if len(P1)*len(P2) <= _dense_size:
+        C = cdist(P1, P2)
+        return max(C.min(0).max(), C.min(1).max())
+    return max(directed_hausdorff(P1, P2)[0], directed_hausdorff(P2, P1)[0])
 
 metrics['hausdorff'] = hausdorff
 
@@ -95,11 +214,120 @@ def jaccard(ann1, ann2):
     value between 0 and 1. Distance 0 indicates perfect overlap
     (intersection/union = 1), while distance 1 indicates no overlap.
 
+    The point sets (see `Annotation._as_set`) are kept as boolean masks,
+    cached per annotation, and only compared inside the intersection of
+    their bounding boxes.
+
     [1]: https://en.wikipedia.org/wiki/Jaccard_index
     """
-    A1 = ann1._as_set()
-    A2 = ann2._as_set()
-    I = len(A1.intersection(A2))
-    return 1.0 - I*1.0 / len(A1.union(A2))
+    I, U = voxel_overlap(annotation_geometry(ann1),
+                         annotation_geometry(ann2))
+    return 1.0 - I*1.0 / U
 
 metrics['jaccard'] = jaccard
+
+def _reduced_pairdist(points, which):
+    """
+    Fill the upper triangle of the 'min' or 'max' `pairdist` matrix. The
+    distances from the points of annotation `i` to the points of all
+    annotations `j > i` are computed in a few `cdist` calls and reduced
+    per annotation with `reduceat`, instead of one call per pair.
+    """
+    N = len(points)
+    D = np.zeros((N, N))
+    reduce_ = np.minimum if which == 'min' else np.maximum
+    sizes = np.array([len(p) for p in points])
+
+    for i in range(N-1):
+        # Group the annotations j > i into blocks of bounded size.
+        j = i+1
+        while j < N:
+            total = 0
+            k = j
+            while k < N and (k == j or (total+sizes[k])*sizes[i] <= _block_size):
+                total += sizes[k]
+                k += 1
+
+            dists = cdist(points[i], np.vstack(points[j:k]))
+            dists = reduce_.reduce(dists, axis=0)
+            starts = np.r_[0, np.cumsum(sizes[j:k-1])]
+            D[i, j:k] = reduce_.reduceat(dists, starts)
+            j = k
+
+    return D
+
+def _tree_pairdist(anns, which):
+    """
+    Fill the upper triangle of the 'min' `pairdist` or the 'hausdorff'
+    matrix. For each annotation `i`, the points of the other annotations
+    are queried at once against the KD-tree of `i`, and the distances to
+    their nearest neighbours are reduced per annotation with `reduceat`.
+    """
+    N = len(anns)
+    points = [annotation_points(a) for a in anns]
+    sizes = np.array([len(p) for p in points])
+
+    # H[j,i] is the min (resp. max) over the points of `j` of the
+    # distance to the nearest point of `i`.
+    H = np.zeros((N, N))
+    reduce_ = np.minimum if which == 'min' else np.maximum
+    for i in range(N):
+        others = np.arange(i+1, N) if which == 'min' else \
+                 np.r_[0:i, i+1:N].astype(int)
+        if len(others) == 0:
+            continue
+        dists, _ = annotation_tree(anns[i]).query(
+            np.vstack([points[j] for j in others]))
+        starts = np.r_[0, np.cumsum(sizes[others])[:-1]]
+        H[others, i] = reduce_.reduceat(dists, starts)
+
+    D = H.T if which == 'min' else np.maximum(H, H.T)
+    return np.triu(D, 1)
+
+def distance_matrix(anns, metric='min'):
+    """
+    Compute the symmetric matrix of distances, `D[i,j] = metric(anns[i],
+    anns[j])`, between a list of annotations.
+
+    metric: str or callable
+        See `metrics.keys()` for the available metrics. If callable,
+        it should take two annotations and return a float.
+
+    When `metric` is a string, the matrix is cached for the given
+    annotations, so repeated calls (e.g., by `Scan.cluster_annotations`)
+    are free. The returned matrix is read-only.
+
+    The 'min' and 'hausdorff' matrices of all the annotations are computed
+    with one KD-tree query per annotation, and the 'max' matrix between
+    convex hull vertices only. E.g., for all the annotations of a scan::
+
+        D = distance_matrix(scan.annotations, 'hausdorff')
+    """
+    key = None
+    if isinstance(metric, str):
+        if metric not in metrics:
+            raise ValueError("Invalid metric: %s. Available metrics are: %s"
+                             % (metric, list(metrics.keys())))
+        if all(ann.id is not None for ann in anns):
+            key = (metric, tuple(ann.id for ann in anns))
+            D = _matrix_cache.get(key)
+            if D is not None:
+                return D
+
+    N = len(anns)
+    if metric in ('min', 'hausdorff'):
+        D = _tree_pairdist(anns, metric)
+    elif metric == 'max':
+        D = _reduced_pairdist([annotation_hull(a) for a in anns], metric)
+    else:
+        func = metrics[metric] if isinstance(metric, str) else metric
+        D = np.zeros((N, N))
+        for i in range(N):
+            for j in range(i+1, N):
+                D[i, j] = func(anns[i], anns[j])
+
+    D = D + D.T
+    D.flags.writeable = False
+    if key is not None:
+        _matrix_cache[key] = D
+    return D
@@ -0,0 +1,64 @@
+"""
+Eager loading of whole cohorts. The relationships of the models are lazy,
+so walking the annotations and contours of many scans one object at a
+time costs a SELECT per relationship per object. `load_cohort` instead
+fetches the scans together with their annotations, contours and slice z
+values with one query per table (`selectinload`), after which traversing
+the object graph (e.g., `cluster_annotations`, `contours_matrix`,
+`slice_zvals`) does not touch the database.
+"""
+from sqlalchemy.orm import selectinload
+
+from .Scan       import Scan
+from .Annotation import Annotation
+
+
+def cohort_query(patient_ids=None, session=None):
+    """
+    The query of the scans of `patient_ids` (all the scans if None),
+    ordered by id, with the eager loading options of `load_cohort`.
+    """
+    if session is None:
+        from . import _session as session
+
+    query = session.query(Scan)
+    if patient_ids is not None:
+        query = query.filter(Scan.patient_id.in_(list(patient_ids)))
+
+    return query.options(
+        selectinload(Scan.annotations).selectinload(Annotation.contours),
+        selectinload(Scan.zvals)
+    ).order_by(Scan.id)
+
+
+def load_cohort(patient_ids=None, first_scan_only=False, session=None):
+    """
+    Load the scans of a cohort with their annotations, contours and slice
+    z values.
+
+    Parameters
+    ----------
+    patient_ids: list of str, default=None
+        The patients to load, e.g., `['LIDC-IDRI-0078']`. All the patients
+        of the database by default.
+
+    first_scan_only: bool, default=False
+        If True, only the first scan (lowest id) of each patient is kept.
+
+    session: sqlalchemy session, default=None
+        The session used to query the database. The session of the
+        current thread by default (see `pylidc.session_factory`).
+
+    Return
+    ------
+    scans: list of pylidc.Scan
+        The scans, ordered by id. Their objects belong to `session`.
+    """
+    scans = cohort_query(patient_ids, session).all()
+
+    if first_scan_only:
+        seen = set()
+        scans = [s for s in scans
+                 if not (s.patient_id in seen or seen.add(s.patient_id))]
+
+    return scans
@@ -0,0 +1,219 @@
+"""
+A columnar copy of the pylidc database for analyses that only need a few
+columns. The `scans`, `annotations`, `contours` and `zvals` tables are
+read straight from the sqlite file (without building ORM objects) into
+pandas data frames, and can be exported to (and loaded from) Parquet
+files with pyarrow. pyarrow is listed in the project requirements, but
+the rest of the module works without it.
+
+The contour `coords` strings are parsed once into a flat `points` table
+of (i,j) int32 coordinates: the points of the contour in row `c` of
+`contours` are the rows `offsets[c]:offsets[c+1]` of `points`, with
+`offsets = np.r_[contours.offset, len(points)]`.
+"""
+import os
+import sqlite3
+from contextlib import closing
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+tables = ('scans', 'annotations', 'contours', 'points', 'zvals')
+
+_queries = {
+    'scans': 'SELECT id, study_instance_uid, series_instance_uid, '
+             'patient_id, slice_thickness, pixel_spacing, contrast_used, '
+             'is_from_initial FROM scans ORDER BY id',
+    'annotations': 'SELECT * FROM annotations ORDER BY id',
+    'contours': 'SELECT id, annotation_id, inclusion, image_z_position, '
+                'dicom_file_name, coords FROM contours ORDER BY id',
+    'zvals': 'SELECT id, scan_id, val FROM zvals ORDER BY id',
+}
+
+_bool_columns = {'scans': ['contrast_used', 'is_from_initial'],
+                 'contours': ['inclusion']}
+
+
+def _require_pyarrow():
+    if pq is None:
+        raise ImportError('pyarrow is required to read and write Parquet '
+                          'files (pip install pyarrow).')
+
+
+def _parse_coords(coords):
+    """
+    Parse the `coords` strings ("x,y" lines) of all the contours at once
+    into a flat (n,2) int32 array of (i,j) points, as `Contour.to_matrix`,
+    and the offset of each contour in it.
+    """
+    coords = [s.replace('\n', ',') for s in coords]
+    sizes  = np.array([s.count(',')//2 + 1 for s in coords], dtype=np.int64)
+    points = np.array(','.join(coords).split(','), dtype=np.int32)
+    offsets = np.r_[0, np.cumsum(sizes)[:-1]]
+    return np.ascontiguousarray(points.reshape(-1, 2)[:,::-1]), offsets
+
+
+class ColumnarDatabase(object):
+    """
+    The tables of the pylidc database as pandas data frames, see the
+    module docstring. Use `from_sqlite` or `from_parquet` to create one.
+
+    Example
+    -------
+    An example::
+
+        from customPylidc.columnar import ColumnarDatabase
+
+        db = ColumnarDatabase.from_sqlite()
+        print(db.scans_per_patient().value_counts())
+        db.to_parquet('lidc_columnar')
+    """
+    def __init__(self, scans, annotations, contours, points, zvals):
+        self.scans       = scans
+        self.annotations = annotations
+        self.contours    = contours
+        self.points      = points
+        self.zvals       = zvals
+
+    @classmethod
+    def from_sqlite(cls, dbpath=None):
+        """
+        Read the tables from the sqlite database at `dbpath` (the bundled
+        one by default), which is opened read-only.
+        """
+        if dbpath is None:
+            from . import _dbpath as dbpath
+
+        uri = 'file:%s?mode=ro' % quote(dbpath)
+        with closing(sqlite3.connect(uri, uri=True)) as connection:
+            frames = dict((name, pd.read_sql_query(query, connection))
+                          for name,query in _queries.items())
+
+        for name,columns in _bool_columns.items():
+            frames[name][columns] = frames[name][columns].astype(bool)
+
+        contours = frames['contours']
+        points, offsets = _parse_coords(contours.pop('coords'))
+        contours['offset'] = offsets
+        frames['points'] = pd.DataFrame({'i': points[:,0], 'j': points[:,1]})
+
+        return cls(**frames)
+
+    @classmethod
+    def from_parquet(cls, directory):
+        """Load the tables written by `to_parquet` (requires pyarrow)."""
+        _require_pyarrow()
+        return cls(**dict(
+            (name, pq.read_table(os.path.join(directory, name + '.parquet'))
+                     .to_pandas())
+            for name in tables))
+
+    def to_arrow(self):
+        """The tables as a dict of `pyarrow.Table` (requires pyarrow)."""
+        _require_pyarrow()
+        return dict((name, pa.Table.from_pandas(getattr(self, name),
+                                                preserve_index=False))
+                    for name in tables)
+
+    def to_parquet(self, directory):
+        """
+        Write each table to `directory/<table>.parquet` (requires pyarrow).
+        The directory is created if it does not exist.
+        """
+        arrow_tables = self.to_arrow()
+        os.makedirs(directory, exist_ok=True)
+        for name,table in arrow_tables.items():
+            pq.write_table(table, os.path.join(directory, name + '.parquet'))
+
+    # # ------------ #
+    # | Query layer. |
+    # # ------------ #
+
+    @property
+    def offsets(self):
+        """The offsets of the contours in `points`, shape=(ncontours+1,)."""
+        return np.r_[self.contours['offset'].values, len(self.points)]
+
+    def contour_points(self, contour_id):
+        """
+        The (n,2) array of the (i,j) points of a contour. Raises a
+        `KeyError` if there is no contour with this id.
+        """
+        ids = self.contours['id'].values
+        c = np.searchsorted(ids, contour_id)
+        if c == len(ids) or ids[c] != contour_id:
+            raise KeyError(contour_id)
+        start, stop = self.offsets[c:c+2]
+        return self.points.values[start:stop]
+
+    def patient_count(self):
+        """The number of distinct patients."""
+        return self.scans['patient_id'].nunique()
+
+    def scans_per_patient(self):
+        """The number of scans of each patient, indexed by patient id."""
+        return self.scans.groupby('patient_id').size()
+
+    def annotations_per_scan(self):
+        """The number of annotations of each scan, indexed by scan id."""
+        return self.annotations.groupby('scan_id').size() \
+                   .reindex(self.scans['id'], fill_value=0)
+
+    def contours_per_annotation(self):
+        """
+        The number of contours of each annotation, indexed by annotation
+        id.
+        """
+        return self.contours.groupby('annotation_id').size() \
+                   .reindex(self.annotations['id'], fill_value=0)
+
+    def annotation_table(self):
+        """
+        The annotations joined with the patient id and the spacings of
+        their scans.
+        """
+        scans = self.scans[['id', 'patient_id', 'slice_thickness',
+                            'pixel_spacing']]
+        return self.annotations.merge(scans.rename(columns={'id': 'scan_id'}),
+                                      on='scan_id', how='left')
+
+    def aggregate(self, by='scan_id', columns=None, func='mean'):
+        """
+        Aggregate the annotation characteristics (e.g., `malignancy`) with
+        a pandas group-by.
+
+        Parameters
+        ----------
+        by: str or list of str, default='scan_id'
+            The grouping columns of `annotation_table`, e.g.,
+            'patient_id' or ['scan_id', '_nodule_id'].
+
+        columns: list of str, default=None
+            The columns to aggregate. All the characteristics by default.
+
+        func: str, callable, list or dict, default='mean'
+            Passed to `DataFrameGroupBy.agg`.
+        """
+        table = self.annotation_table()
+        if columns is None:
+            columns = [c for c in self.annotations.columns
+                       if c not in ('id', 'scan_id', '_nodule_id')]
+        return table.groupby(by)[columns].agg(func)
+
+
+def export_parquet(directory, dbpath=None):
+    """
+    Export the pylidc database at `dbpath` (the bundled one by default)
+    to Parquet files in `directory`, see `ColumnarDatabase.to_parquet`.
+    """
+    database = ColumnarDatabase.from_sqlite(dbpath)
+    database.to_parquet(directory)
+    return database
@@ -0,0 +1,159 @@
+"""
+A persistent, on-disk index that maps DICOM series instance uids to the
+directory (relative to the dataset root) where the series' files are stored.
+
+Recent TCIA downloads of the LIDC-IDRI dataset use an unknown folder
+hierarchy under each "LIDC-IDRI-dddd" folder, so locating a series
+requires walking the patient folder and reading a DICOM header in every
+directory. The index records the result of each walk so that this is
+only done once per series. Entries store the modification time of the
+series directory and are discarded when it changes.
+"""
+import os
+import json
+import tempfile
+import threading
+
+import pydicom as dicom
+
+
+_uid_tags = ['SeriesInstanceUID', 'StudyInstanceUID']
+
+
+def _dicom_files(fnames):
+    """Filter the DICOM file names in a directory listing."""
+    return [f for f in fnames if f.endswith('.dcm') and not f.startswith('.')]
+
+
+def read_series_uids(fname):
+    """
+    Read the (series, study) instance uids of a DICOM file. Only the
+    header is parsed; the reading stops before the pixel data.
+    """
+    dimage = dicom.dcmread(fname, stop_before_pixels=True,
+                           specific_tags=_uid_tags)
+    seid = str(dimage.SeriesInstanceUID).strip()
+    stid = str(dimage.StudyInstanceUID).strip()
+    return seid, stid
+
+
+class SeriesIndex(object):
+    """
+    Maps series instance uids to series directories, persisted as a JSON
+    file. Each entry holds the path of the series directory relative to the
+    dataset root, the study instance uid and the directory's `st_mtime`.
+
+    Parameters
+    ----------
+    filename: string
+        Path to the JSON file backing the index. It is created on the
+        first call to `save` if it does not exist.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock    = threading.RLock()
+        self._entries = {}
+        self._dirty   = False
+
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                # A corrupt index is simply rebuilt.
+                self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, root, series_instance_uid, study_instance_uid):
+        """
+        Return the absolute path of the series directory, or None if the
+        series is not indexed or its entry is out of date.
+        """
+        with self._lock:
+            entry = self._entries.get(series_instance_uid)
+            if entry is None:
+                return None
+
+            path = os.path.join(root, entry['path'])
+            valid = (entry['study_instance_uid'] == study_instance_uid and
+                     os.path.isdir(path) and
+                     os.stat(path).st_mtime == entry['mtime'])
+            if not valid:
+                del self._entries[series_instance_uid]
+                self._dirty = True
+                return None
+            return path
+
+    def add(self, root, path, series_instance_uid, study_instance_uid):
+        """Record that the series is stored in the directory `path`."""
+        with self._lock:
+            self._entries[series_instance_uid] = {
+                'path': os.path.relpath(path, root),
+                'study_instance_uid': study_instance_uid,
+                'mtime': os.stat(path).st_mtime,
+            }
+            self._dirty = True
+
+    def index_tree(self, root, base=None, verbose=False):
+        """
+        Walk `base` (default, `root`) and record every directory that
+        holds DICOM files. The first DICOM file of a directory is assumed
+        to carry the series/study uids of all the files in it. Directories
+        whose entry is still valid are not read again.
+
+        Return
+        ------
+        n: int
+            The number of directories (re)indexed.
+        """
+        base  = root if base is None else base
+        known = set()
+        with self._lock:
+            for seid, entry in self._entries.items():
+                known.add((entry['path'], entry['mtime']))
+
+        n = 0
+        for dpath, dnames, fnames in os.walk(base):
+            dicom_files = _dicom_files(fnames)
+
+            # Skip if no DICOM files.
+            if len(dicom_files) == 0: continue
+
+            key = (os.path.relpath(dpath, root), os.stat(dpath).st_mtime)
+            if key in known: continue
+
+            seid, stid = read_series_uids(os.path.join(dpath, dicom_files[0]))
+            self.add(root, dpath, seid, stid)
+            n += 1
+
+            if verbose:
+                print("Indexed %s" % dpath)
+        return n
+
+    def save(self):
+        """
+        Write the index to disk if it changed. The file is replaced
+        atomically so concurrent readers never see a partial index.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+
+            # A unique temporary file per call, so that concurrent saves
+            # (from other threads or processes) never share one.
+            with tempfile.NamedTemporaryFile('w', dir=dirname or '.',
+                                             suffix='.tmp',
+                                             delete=False) as f:
+                json.dump(self._entries, f)
+            try:
+                os.replace(f.name, self.filename)
+            except OSError:
+                os.remove(f.name)
+                raise
+            self._dirty = False
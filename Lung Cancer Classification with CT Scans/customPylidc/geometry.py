@@ -0,0 +1,717 @@
+"""
+Array-backed contour geometry for annotations. The `coords` strings of all
+the contours of an annotation are parsed once into packed numpy arrays,
+which the geometric properties of :class:`pylidc.Annotation` (centroid,
+bounding box, diameter, volume, masks, ...) read from instead of parsing
+each contour again through `Contour.to_matrix`.
+
+Geometries are cached by annotation id and the sorted slice z values by
+scan id, keeping only the most recently used ones so that walking a whole
+cohort does not keep every annotation in memory. Call `clear_cache` if the
+contours of an annotation change.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache(object):
+    """
+    A mapping that keeps at most `maxsize` entries, dropping the least
+    recently used ones first. It is safe to use from several threads.
+    """
+    def __init__(self, maxsize):
+        self.maxsize  = maxsize
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Each geometry holds the parsed contours and, once computed, the contour
+# fills and the voxel mask of the annotation, i.e., up to a few MB, while
+# a scan has at most a few dozen annotations.
+_geometry_cache = LRUCache(256)
+_slice_zvals_cache = LRUCache(256)
+
+# Caches of other modules that hold values computed from several
+# geometries (e.g., the distance matrices of `annotation_distance_metrics`),
+# which `clear_cache` drops as well.
+_dependent_caches = []
+
+
+def scan_slice_zvals(scan):
+    """
+    Return `scan.slice_zvals`, cached by scan id.
+    """
+    zs = _slice_zvals_cache.get(scan.id) if scan.id is not None else None
+    if zs is None:
+        zs = scan.slice_zvals
+        zs.flags.writeable = False
+        if scan.id is not None:
+            _slice_zvals_cache[scan.id] = zs
+    return zs
+
+
+class AnnotationGeometry(object):
+    """
+    The contours of an annotation as packed arrays. The contours are kept
+    in the order of `annotation.contours`.
+
+    Attributes
+    ----------
+    points: ndarray, shape=(n,2)
+        The (i,j) index coordinates of all the contour points.
+
+    offsets: ndarray, shape=(ncontours+1,)
+        The points of contour `c` are `points[offsets[c]:offsets[c+1]]`.
+
+    inclusion: ndarray, shape=(ncontours,)
+        The `inclusion` flag of each contour.
+
+    zvals: ndarray, shape=(ncontours,)
+        The `image_z_position` of each contour.
+
+    kvals: ndarray, shape=(ncontours,)
+        The `image_k_position` of each contour, i.e., the index of the
+        closest scan slice.
+
+    derived: dict
+        Values computed from the geometry by other modules (e.g., the
+        KD-tree of `annotation_distance_metrics`), which are cached and
+        evicted together with it.
+
+    Parameters
+    ----------
+    annotation: pylidc.Annotation
+    """
+    def __init__(self, annotation):
+        contours = annotation.contours
+
+        # The reversal [:,::-1] is because the coordinates from the LIDC
+        # XML are stored as (x,y), not (i,j).
+        coords = [c.coords.replace('\n', ',') for c in contours]
+        values = np.array(','.join(coords).split(','), dtype=np.int64)
+        self.points = values.reshape(-1,2)[:,::-1].copy()
+
+        sizes = [s.count(',')//2 + 1 for s in coords]
+        self.offsets   = np.r_[0, np.cumsum(sizes)].astype(np.int64)
+        self.inclusion = np.array([c.inclusion for c in contours], dtype=bool)
+        self.zvals     = np.array([c.image_z_position for c in contours],
+                                  dtype=np.float64)
+
+        zs = scan_slice_zvals(annotation.scan)
+        self.kvals = np.abs(zs[None,:] - self.zvals[:,None]).argmin(axis=1)
+
+        # Contour order by increasing z value (`sorted` is stable).
+        self.z_order = np.argsort(self.zvals, kind='stable')
+        self._contours_matrix = None
+        self._fills = None
+        self._voxels = None
+        self._diameters = None
+        self.derived = {}
+
+        for a in ['points', 'offsets', 'inclusion', 'zvals', 'kvals']:
+            getattr(self, a).flags.writeable = False
+
+    def __len__(self):
+        return len(self.zvals)
+
+    def contour_points(self, c):
+        """Return the (i,j) points of contour `c`."""
+        return self.points[self.offsets[c]:self.offsets[c+1]]
+
+    @property
+    def sizes(self):
+        """The number of points of each contour."""
+        return np.diff(self.offsets)
+
+    @property
+    def contours_matrix(self):
+        """
+        The (i,j,k) points of all the contours, the contours being sorted
+        by z value (see `Annotation.contours_matrix`). Read-only.
+        """
+        if self._contours_matrix is None:
+            sizes = self.sizes
+            index = np.concatenate([np.arange(self.offsets[c],
+                                              self.offsets[c+1])
+                                    for c in self.z_order])
+            k = np.repeat(self.kvals[self.z_order], sizes[self.z_order])
+            matrix = np.c_[self.points[index], k].astype(int)
+            matrix.flags.writeable = False
+            self._contours_matrix = matrix
+        return self._contours_matrix
+
+    @property
+    def fills(self):
+        """
+        The (contour index, i, j) of the pixels enclosed by each contour,
+        see `fill_polygons`. Read-only.
+        """
+        if self._fills is None:
+            fills = fill_polygons(self.points, self.offsets)
+            for a in fills:
+                a.flags.writeable = False
+            self._fills = fills
+        return self._fills
+
+    @property
+    def voxels(self):
+        """
+        The voxel set of the annotation used to compute overlaps (see
+        `Annotation._as_set`) as a boolean mask: the pixels enclosed by
+        the inclusion contours minus those enclosed by the exclusion
+        contours, the contour points themselves being kept. Read-only.
+
+        Return
+        ------
+        origin: ndarray, shape=(2,)
+            The (i,j) index coordinates of `mask[0,0]`.
+
+        zvals: ndarray, shape=(nz,)
+            The sorted z values of the slices of `mask`.
+
+        mask: ndarray, shape=(ni,nj,nz)
+            The voxel set, bounded by its bounding box.
+
+        count: int
+            The number of voxels in the set.
+        """
+        if self._voxels is None:
+            c, i, j = fill_polygons(self.points, self.offsets,
+                                    strict_closing=True)
+            zvals, z = np.unique(self.zvals, return_inverse=True)
+            z = z.reshape(-1)[c]
+            incl = self.inclusion[c]
+
+            if incl.any():
+                origin = np.array([i[incl].min(), j[incl].min()])
+                shape  = (i[incl].max() - origin[0] + 1,
+                          j[incl].max() - origin[1] + 1, len(zvals))
+            else:
+                origin = np.zeros(2, dtype=np.int64)
+                shape  = (0, 0, len(zvals))
+            mask = np.zeros(shape, dtype=bool)
+            mask[i[incl]-origin[0], j[incl]-origin[1], z[incl]] = True
+
+            # Exclusion pixels outside of the box are not in the set anyway.
+            i, j, z = i[~incl]-origin[0], j[~incl]-origin[1], z[~incl]
+            inbox = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1])
+            mask[i[inbox], j[inbox], z[inbox]] = False
+
+            for a in [origin, zvals, mask]:
+                a.flags.writeable = False
+            self._voxels = (origin, zvals, mask, int(mask.sum()))
+        return self._voxels
+
+    @property
+    def diameters(self):
+        """
+        The greatest distance between two points of each contour, in
+        pixels, see `contour_diameters`. Read-only.
+        """
+        if self._diameters is None:
+            self._set_diameters(contour_diameters(self.points, self.offsets))
+        return self._diameters
+
+    def _set_diameters(self, diameters):
+        for a in diameters:
+            a.flags.writeable = False
+        self._diameters = diameters
+
+
+def _pack_geometries(geometries):
+    """
+    Concatenate the contours of several annotation geometries.
+
+    Return
+    ------
+    points, offsets: ndarrays
+        As `AnnotationGeometry.points` and `offsets`.
+
+    split: ndarray
+        The contours of geometry `g` are those of the `g`th array of
+        `np.split(..., split)`.
+    """
+    points  = np.concatenate([g.points for g in geometries])
+    starts  = np.r_[0, np.cumsum([g.offsets[-1] for g in geometries])]
+    offsets = np.concatenate([g.offsets[:-1] + o for g,o in
+                              zip(geometries, starts)] + [starts[-1:]])
+    split = np.cumsum([len(g) for g in geometries])[:-1]
+    return points, offsets, split
+
+
+def _prune_chain(c, x, y, sign):
+    """
+    Reduce chains of points (grouped by contour `c`, with increasing `x`
+    in each group) to their lower (`sign=1`) or upper (`sign=-1`) convex
+    hull. Interior points that do not make a strict turn with their
+    neighbours cannot be hull vertices and are dropped, all at once,
+    until every remaining interior point does.
+
+    Return
+    ------
+    keep: ndarray
+        The indices of the points of the hull chains.
+    """
+    keep = np.arange(len(c))
+    while len(keep) > 2:
+        cc, xx, yy = c[keep], x[keep], y[keep]
+        cross = (xx[1:-1]-xx[:-2])*(yy[2:]-yy[:-2]) - \
+                (yy[1:-1]-yy[:-2])*(xx[2:]-xx[:-2])
+        interior = (cc[1:-1] == cc[:-2]) & (cc[1:-1] == cc[2:])
+        drop = np.flatnonzero(interior & (sign*cross <= 0)) + 1
+        if len(drop) == 0:
+            break
+        keep = np.delete(keep, drop)
+    return keep
+
+
+def convex_hulls(points, offsets):
+    """
+    The convex hull of each contour with Andrew's monotone chain, built
+    for all the contours at once. Only the lowest and highest point of
+    each column can be a vertex of the hull, so the lower and upper
+    chains are pruned from the column extremes (see `_prune_chain`).
+    The arithmetic is exact on the integer points.
+
+    Return
+    ------
+    hull: ndarray, shape=(n,2)
+        The hull vertices of contour `c`, `hull[hull_offsets[c]:
+        hull_offsets[c+1]]`, in order around the hull and without
+        collinear points.
+
+    hull_offsets: ndarray, shape=(ncontours+1,)
+    """
+    ncontours = len(offsets) - 1
+    c = np.repeat(np.arange(ncontours), np.diff(offsets))
+    shift = np.minimum(points.min(axis=0, initial=0), 0)
+    x, y = (points - shift).T
+
+    # Sort by (contour, x, y) on a single packed key.
+    width, height = x.max(initial=0) + 1, y.max(initial=0) + 1
+    order = np.argsort((c*width + x)*height + y)
+    c, x, y = c[order], x[order], y[order]
+
+    # The lowest (first) and highest (last) point of each column.
+    column = np.r_[True, (c[1:] != c[:-1]) | (x[1:] != x[:-1])]
+    lows   = np.flatnonzero(column)
+    highs  = np.r_[lows[1:]-1, len(c)-1]
+    lows   = lows[_prune_chain(c[lows], x[lows], y[lows], 1)]
+    highs  = highs[_prune_chain(c[highs], x[highs], y[highs], -1)]
+
+    # The lower chain from left to right, then the upper chain from
+    # right to left.
+    index = np.r_[lows, highs]
+    upper = np.r_[np.zeros(len(lows), dtype=bool),
+                  np.ones(len(highs), dtype=bool)]
+    order = np.argsort((2*c[index] + upper)*width +
+                       np.where(upper, width-1 - x[index], x[index]))
+    index, upper = index[order], upper[order]
+    hc, hx, hy = c[index], x[index], y[index]
+
+    # Drop the ends of the upper chains that coincide with the ends of
+    # the lower chains.
+    first = np.r_[True, hc[1:] != hc[:-1]]
+    last  = np.r_[hc[1:] != hc[:-1], True]
+    start = np.maximum.accumulate(np.where(first, np.arange(len(hc)), 0))
+    dup = np.zeros(len(hc), dtype=bool)
+    dup[1:] = (hx[1:] == hx[:-1]) & (hy[1:] == hy[:-1])
+    dup |= last & (hx == hx[start]) & (hy == hy[start])
+    dup &= upper & ~first
+
+    hull = np.c_[hx, hy][~dup] + shift
+    hull_offsets = np.r_[0, np.cumsum(np.bincount(hc[~dup],
+                                                  minlength=ncontours))]
+    return hull, hull_offsets
+
+
+def contour_diameters(points, offsets):
+    """
+    The greatest distance between two points of each contour, found with
+    rotating calipers on its convex hull (see `convex_hulls`) in
+    O(n log n) time and O(n) memory, instead of computing all the
+    pairwise distances. The calipers of all the contours are rotated in
+    lockstep.
+
+    Return
+    ------
+    sqdiams: ndarray, shape=(ncontours,)
+        The (integer) squared diameter of each contour, or -1 for contours
+        with a single point.
+
+    ends: ndarray, shape=(ncontours,2,2)
+        The (i,j) coordinates of the two ends of each diameter.
+    """
+    hull, hull_offsets = convex_hulls(points, offsets)
+    hx, hy = hull[:,0], hull[:,1]
+    n = np.diff(hull_offsets)
+    base = hull_offsets[:-1]
+
+    def sqdist(p, q):
+        return (hx[p] - hx[q])**2 + (hy[p] - hy[q])**2
+
+    # Hulls with less than 3 vertices are segments (or points).
+    ends = np.c_[base, base + n - 1]
+    sqdiams = sqdist(ends[:,0], ends[:,1])
+
+    # For each edge (i,i+1), the antipodal vertex j advances while its
+    # distance to the edge (twice the triangle area) increases; then
+    # both ends of the edge are compared against it.
+    active = np.flatnonzero(n >= 3)
+    i = np.zeros(len(active), dtype=np.int64)
+    j = np.ones(len(active), dtype=np.int64)
+    sqdiams[active] = -1
+    while len(active):
+        nn, bb = n[active], base[active]
+        a, b = bb + i, bb + (i+1) % nn
+        k, knext = bb + j, bb + (j+1) % nn
+        ax, ay = hx[a], hy[a]
+        ex, ey = hx[b] - ax, hy[b] - ay
+        advance = np.abs(ex*(hy[knext]-ay) - ey*(hx[knext]-ax)) > \
+                  np.abs(ex*(hy[k]-ay) - ey*(hx[k]-ax))
+        j[advance] = (j[advance] + 1) % nn[advance]
+
+        done = np.flatnonzero(~advance)
+        for p in (a[done], b[done]):
+            d = sqdist(p, k[done])
+            better = d > sqdiams[active[done]]
+            sqdiams[active[done][better]] = d[better]
+            ends[active[done][better]] = np.c_[p, k[done]][better]
+        i[done] += 1
+
+        remaining = i < nn
+        active, i, j = active[remaining], i[remaining], j[remaining]
+
+    sqdiams[np.diff(offsets) == 1] = -1
+    return sqdiams, hull[ends]
+
+
+def annotation_diameters(annotations):
+    """
+    The greatest axial plane diameter (see `Annotation.diameter`) of each
+    annotation, in mm. The contour diameters of all the annotations are
+    computed in one `contour_diameters` call.
+
+    Parameters
+    ----------
+    annotations: list of pylidc.Annotation
+
+    Return
+    ------
+    diameters: ndarray, shape=(len(annotations),)
+    """
+    geometries = [annotation_geometry(ann) for ann in annotations]
+
+    # Pack the contours whose diameters are not known yet.
+    missing = [g for g in geometries if g._diameters is None]
+    if len(missing) > 0:
+        points, offsets, split = _pack_geometries(missing)
+        sqdiams, ends = contour_diameters(points, offsets)
+        for g,sq,e in zip(missing, np.split(sqdiams, split),
+                          np.split(ends, split)):
+            g._set_diameters((sq, e))
+
+    diameters = np.full(len(annotations), -np.inf)
+    sizes = np.array([len(g) for g in geometries])
+    if sizes.sum() == 0:
+        return diameters
+    sqdiams = np.concatenate([g.diameters[0] for g in geometries])
+    ends    = np.concatenate([g.diameters[1] for g in geometries])
+
+    # The first contour with the greatest diameter of each annotation.
+    group = np.repeat(np.arange(len(annotations)), sizes)
+    order = np.lexsort((-sqdiams, group))
+    first = order[np.r_[0, np.cumsum(sizes[sizes > 0])[:-1]]]
+    found = group[first][sqdiams[first] >= 0]
+    first = first[sqdiams[first] >= 0]
+
+    # The ends are scaled before taking their distance, as the previous
+    # pairwise distances were computed in mm.
+    spacing = np.array([annotations[a].scan.pixel_spacing for a in found])
+    p, q = ends[first,0] * spacing[:,None], ends[first,1] * spacing[:,None]
+    diameters[found] = np.sqrt(((p - q)**2).sum(axis=1))
+    return diameters
+
+
+def annotation_volumes(annotations):
+    """
+    The volume (see `Annotation.volume`) of each annotation, in cubic mm.
+    The spacing of each slice is computed from a single sorted array of
+    the (annotation, z value) pairs, and the contributions of all the
+    contours are summed in one `np.bincount` call. The area of each
+    contour is evaluated on its points in mm, with the same operations
+    and summation order as the original `Annotation.volume` loop, so the
+    volumes are bitwise identical to it.
+
+    Parameters
+    ----------
+    annotations: list of pylidc.Annotation
+
+    Return
+    ------
+    volumes: ndarray, shape=(len(annotations),)
+    """
+    geometries = [annotation_geometry(ann) for ann in annotations]
+
+    volumes = np.zeros(len(annotations))
+    sizes = np.array([len(g) for g in geometries], dtype=np.int64)
+    if sizes.sum() == 0:
+        return volumes
+    group = np.repeat(np.arange(len(annotations)), sizes)
+    zvals = np.concatenate([g.zvals for g in geometries])
+
+    # The distinct z values of each annotation, sorted.
+    order = np.lexsort((zvals, group))
+    new = np.r_[True, (group[order][1:] != group[order][:-1]) |
+                      (zvals[order][1:] != zvals[order][:-1])]
+    ug, uz = group[order][new], zvals[order][new]
+    slot = np.empty(len(zvals), dtype=np.int64)
+    slot[order] = np.cumsum(new) - 1
+
+    # The spacing of each slice is half the distance between the slices
+    # below and above it. The end slices are padded by mirroring their
+    # neighbour; annotations with a single slice use `slice_thickness`.
+    first = np.r_[True, ug[1:] != ug[:-1]]
+    last  = np.r_[ug[1:] != ug[:-1], True]
+    below = np.r_[uz[0], uz[:-1]]
+    above = np.r_[uz[1:], uz[-1]]
+    single = first & last
+    below = np.where(first & ~single, uz - (above - uz), below)
+    above = np.where(last & ~single, uz + (uz - below), above)
+    spacing = 0.5*(above - below)
+    thickness = np.array([annotations[a].scan.slice_thickness
+                          for a in ug[single]])
+    spacing[single] = thickness
+
+    # "Shoelace" formula for the area of each contour in mm^2.
+    areas = np.empty(len(zvals))
+    k = 0
+    for ann,g in zip(annotations, geometries):
+        pixel_spacing = ann.scan.pixel_spacing
+        for i in range(len(g)):
+            contour_array = g.contour_points(i) * pixel_spacing
+            x = contour_array[:,0]
+            y = contour_array[:,1]
+            areas[k] = 0.5*np.abs(np.dot(x,np.roll(y,1)) -
+                                  np.dot(y,np.roll(x,1)))
+            k += 1
+    signs = np.where(np.concatenate([g.inclusion for g in geometries]),
+                     1., -1.)
+    volumes += np.bincount(group, signs * areas * spacing[slot],
+                           minlength=len(annotations))
+    return volumes
+
+
+def voxel_overlap(geometry1, geometry2):
+    """
+    The number of voxels in the intersection and in the union of the
+    voxel sets (see `AnnotationGeometry.voxels`) of two annotations. The
+    masks are only compared in the intersection of their bounding boxes,
+    on the slices whose z value they share.
+
+    Return
+    ------
+    intersection, union: int
+    """
+    o1, z1, m1, n1 = geometry1.voxels
+    o2, z2, m2, n2 = geometry2.voxels
+
+    lo = np.maximum(o1, o2)
+    hi = np.minimum(o1 + m1.shape[:2], o2 + m2.shape[:2])
+    _, k1, k2 = np.intersect1d(z1, z2, assume_unique=True,
+                               return_indices=True)
+    if (hi <= lo).any() or len(k1) == 0:
+        return 0, n1 + n2
+
+    s1 = m1[lo[0]-o1[0]:hi[0]-o1[0], lo[1]-o1[1]:hi[1]-o1[1]][:,:,k1]
+    s2 = m2[lo[0]-o2[0]:hi[0]-o2[0], lo[1]-o2[1]:hi[1]-o2[1]][:,:,k2]
+    intersection = int(np.count_nonzero(s1 & s2))
+    return intersection, n1 + n2 - intersection
+
+
+def _closed_polygons(points, offsets, strict_closing=False):
+    """
+    The vertices of each contour as a polygon, following `Annotation`'s
+    masks: a contour is closed by appending its first point when it is
+    not closed already, and the closing vertex is then dropped since
+    `matplotlib.path.Path(C, closed=True)` ignores it. Contours whose
+    closed path has less than 3 vertices define no polygon.
+
+    With `strict_closing`, the first point is only appended when it
+    differs from the last one in both coordinates, as `Annotation._as_set`
+    always did; otherwise the last point of the contour is dropped.
+
+    Return
+    ------
+    vertices: ndarray, shape=(n,2)
+    poly_offsets: ndarray, shape=(ncontours+1,)
+    """
+    sizes  = np.diff(offsets)
+    first  = points[offsets[:-1]]
+    last   = points[offsets[1:]-1]
+    if strict_closing:
+        closed = (first == last).any(axis=1)
+    else:
+        closed = (first == last).all(axis=1)
+
+    # Polygon c is `points[offsets[c]:offsets[c]+nverts[c]]`.
+    nverts = np.where(closed, sizes-1, sizes)
+    nverts[nverts+1 < 3] = 0
+
+    poly_offsets = np.r_[0, np.cumsum(nverts)]
+    index = np.repeat(offsets[:-1] - poly_offsets[:-1], nverts) + \
+            np.arange(poly_offsets[-1])
+    return points[index], poly_offsets
+
+
+def fill_polygons(points, offsets, strict_closing=False):
+    """
+    Rasterize the interior of each contour with a scanline even-odd rule.
+
+    The crossing test is the one of matplotlib's `Path.contains_points`
+    (radius 0) used by the previous masks: the ray from a test point
+    `(x,y)` towards +x toggles on the edge `(x0,y0)->(x1,y1)` when
+    `(y0 >= y) != (y1 >= y)` and
+    `((y1-y)*(x0-x1) >= (x1-x)*(y0-y1)) == (y1 >= y)`. With integer
+    vertices this amounts to toggling every `x <= T` on row `y`, with an
+    integer threshold `T` per (edge, row), so the result is exactly the
+    same. Only the bounding box of each contour is filled.
+
+    Parameters
+    ----------
+    points: ndarray, shape=(n,2)
+        Integer contour points, see `AnnotationGeometry.points`.
+
+    offsets: ndarray, shape=(ncontours+1,)
+        See `AnnotationGeometry.offsets`.
+
+    strict_closing: bool, default=False
+        See `_closed_polygons`.
+
+    Return
+    ------
+    c, x, y: ndarrays
+        The contour index and the coordinates of each interior pixel.
+    """
+    verts, poly_offsets = _closed_polygons(points, offsets, strict_closing)
+    npolys = len(poly_offsets) - 1
+    nverts = np.diff(poly_offsets)
+    empty  = np.zeros(0, dtype=np.int64)
+    if verts.shape[0] == 0:
+        return empty, empty, empty
+
+    # Edges v[k] -> v[k+1], plus the closing edge of each polygon.
+    poly = np.repeat(np.arange(npolys), nverts)
+    nxt  = np.arange(verts.shape[0]) + 1
+    ends = poly_offsets[1:][nverts > 0] - 1
+    nxt[ends] = poly_offsets[:-1][nverts > 0]
+
+    x0, y0 = verts[:,0], verts[:,1]
+    x1, y1 = verts[nxt,0], verts[nxt,1]
+
+    # Each edge toggles the rows y with min(y0,y1) < y <= max(y0,y1).
+    lo = np.minimum(y0, y1)
+    nrows = np.abs(y1 - y0)
+    edge = np.repeat(np.arange(verts.shape[0]), nrows)
+    y = np.repeat(lo, nrows) + 1 + \
+        np.arange(edge.shape[0]) - np.repeat(np.cumsum(nrows)-nrows, nrows)
+
+    x0, y0, x1, y1 = x0[edge], y0[edge], x1[edge], y1[edge]
+    up = y1 > y0
+    d  = np.abs(y1 - y0)
+    N  = x1*d + np.where(up, 1, -1)*(y1 - y)*(x0 - x1)
+    T  = np.where(up, N // d, (N - 1) // d)
+
+    # Bounding box of each polygon; the pixels of polygon c are packed
+    # row by row (along y) in `count[base[c]:base[c+1]]`.
+    xmin = np.minimum.reduceat(verts[:,0], poly_offsets[:-1][nverts > 0])
+    xmax = np.maximum.reduceat(verts[:,0], poly_offsets[:-1][nverts > 0])
+    ymin = np.minimum.reduceat(verts[:,1], poly_offsets[:-1][nverts > 0])
+    ymax = np.maximum.reduceat(verts[:,1], poly_offsets[:-1][nverts > 0])
+    polys = np.flatnonzero(nverts > 0)
+    slot  = np.full(npolys, -1)
+    slot[polys] = np.arange(polys.shape[0])
+
+    width  = xmax - xmin + 1
+    height = ymax - ymin + 1
+    base   = np.r_[0, np.cumsum(width*height)]
+
+    s = slot[poly[edge]]
+    keep = T >= xmin[s]
+    s, y, T = s[keep], y[keep], T[keep]
+    count = np.bincount(base[s] + (y - ymin[s])*width[s] + (T - xmin[s]),
+                        minlength=base[-1])
+
+    # The number of toggles at x is the number of thresholds >= x in
+    # its row, i.e., a suffix sum restricted to the row.
+    suffix = np.r_[np.cumsum(count[::-1])[::-1], 0]
+    rows   = np.repeat(np.arange(polys.shape[0]), height)
+    row_end = np.repeat(base[:-1][rows] + (np.arange(rows.shape[0]) -
+                        np.repeat(np.cumsum(height)-height, height) + 1) *
+                        width[rows], width[rows])
+    inside = np.flatnonzero((suffix[:-1] - suffix[row_end]) & 1)
+
+    s = np.searchsorted(base, inside, side='right') - 1
+    local = inside - base[s]
+    return polys[s], xmin[s] + local % width[s], ymin[s] + local // width[s]
+
+
+def annotation_geometry(annotation):
+    """
+    Return the :class:`AnnotationGeometry` of the annotation, cached by
+    annotation id.
+    """
+    key = annotation.id
+    geometry = _geometry_cache.get(key) if key is not None else None
+    if geometry is None:
+        geometry = AnnotationGeometry(annotation)
+        if key is not None:
+            _geometry_cache[key] = geometry
+    return geometry
+
+
+def clear_cache(annotation_id=None):
+    """
+    Drop the cached geometry of the annotation with the given id, or of
+    all annotations (and the cached scan z values) if it is None. The
+    values computed from the geometries (see `AnnotationGeometry.derived`
+    and `_dependent_caches`) are dropped with them.
+    """
+    if annotation_id is None:
+        _geometry_cache.clear()
+        _slice_zvals_cache.clear()
+    else:
+        _geometry_cache.pop(annotation_id, None)
+
+    for cache in _dependent_caches:
+        cache.clear()
@@ -0,0 +1,188 @@
+"""
+Batch resampling of the annotations of a scan to uniform 1mm cubes, as
+`Annotation.uniform_cubic_resample` does for a single annotation. The
+scan volume is loaded once (by default from the on-disk volume cache,
+see `Scan.to_volume`), only the region around each annotation is read
+from it, and the trilinear interpolation is applied one axis at a time
+on float32 data instead of through a generic `RegularGridInterpolator`
+over every point of a flattened meshgrid.
+"""
+import numpy as np
+
+from .geometry import scan_slice_zvals
+
+
+def _linear_weights(grid, points):
+    """
+    The linear interpolation weights of `points` on the increasing
+    `grid`: each point lies between `grid[index]` and `grid[index+1]`,
+    at the fraction `t` of the way. `inside` flags the points within the
+    grid; the others take the fill value.
+    """
+    index = np.searchsorted(grid, points, side='right') - 1
+    index = np.clip(index, 0, len(grid)-2)
+    t = (points - grid[index]) / (grid[index+1] - grid[index])
+    inside = (points >= grid[0]) & (points <= grid[-1])
+    return index, t, inside
+
+
+def _interpolate_axis(values, index, t, axis):
+    """Linearly interpolate `values` along `axis` (separable step)."""
+    shape = [1, 1, 1]
+    shape[axis] = -1
+    t = t.astype(values.dtype).reshape(shape)
+    return np.take(values, index, axis=axis) * (1 - t) + \
+           np.take(values, index+1, axis=axis) * t
+
+
+def _dilate_axis(mask, index, t, axis):
+    """
+    The boolean counterpart of `_interpolate_axis`: a resampled point is
+    in the mask if a neighbour with a nonzero weight is.
+    """
+    shape = [1, 1, 1]
+    shape[axis] = -1
+    return (np.take(mask, index, axis=axis) & (t < 1).reshape(shape)) | \
+           (np.take(mask, index+1, axis=axis) & (t > 0).reshape(shape))
+
+
+def cubic_grid(annotation, side_length, zvals=None):
+    """
+    The (x,y,z) coordinates, in mm, of the points of the uniform cube of
+    `side_length+1` points per side centered on the bounding box of the
+    annotation, as in `Annotation.uniform_cubic_resample`.
+    """
+    bbox = annotation.bbox_matrix()
+    rij  = annotation.scan.pixel_spacing
+    zs   = scan_slice_zvals(annotation.scan) if zvals is None else zvals
+
+    lows  = [bbox[0,0]*rij, bbox[1,0]*rij, zs[bbox[2,0]]]
+    highs = [bbox[0,1]*rij, bbox[1,1]*rij, zs[bbox[2,1]]]
+
+    axes = []
+    for lo,hi,name in zip(lows, highs, 'xyz'):
+        d = 0.5*(side_length - (hi - lo))
+        hat, step = np.linspace(lo-d, hi+d, int(side_length)+1, retstep=True)
+        assert abs(step-1) < 1e-5, "New %s spacing != 1." % name
+        axes.append(hat)
+    return axes
+
+
+def resample_annotations(annotations, side_length=None, volume=None,
+                         resample_vol=True, return_irp_pts=False,
+                         verbose=True):
+    """
+    Resample the CT values and boolean masks of several annotations of the
+    same scan to uniform cubes with 1mm spacing.
+
+    Parameters
+    ----------
+    annotations: list of pylidc.Annotation
+        Annotations of a single scan.
+
+    side_length: integer, default=None
+        The physical length of each side of the cubes in millimeters. The
+        default, `None`, takes the max of the bounding box dimensions of
+        all the annotations, so that the cubes can be stacked.
+
+    volume: ndarray, default=None
+        The scan volume, e.g., the memmap returned by `Scan.to_volume`
+        with `mmap=True`. If None, it is obtained that way.
+
+    resample_vol: boolean, default=True
+        If False, only the masks are resampled and the volume is not
+        loaded.
+
+    return_irp_pts: boolean, default=False
+        If True, the (x,y,z) axes of the grid each annotation was
+        resampled on are also returned.
+
+    verbose: boolean, default=True
+        Turn the loading statement on / off.
+
+    Return
+    ------
+    [ct_volumes,] masks [, irp_pts]: ndarray, ndarray, list
+        The float32 CT values and the boolean masks, stacked in arrays of
+        shape `(len(annotations),) + (side_length+1,)*3`. Points outside
+        of the scan take its minimum value. Unlike
+        `Annotation.uniform_cubic_resample`, which reads the raw pixel
+        values, the CT values are those of `Scan.to_volume`, i.e., in HU.
+    """
+    if len(set(ann.scan_id for ann in annotations)) > 1:
+        raise ValueError('`annotations` must belong to the same scan.')
+
+    n = len(annotations)
+    if n == 0:
+        raise ValueError('`annotations` is empty.')
+    scan = annotations[0].scan
+
+    # { Begin input checks.
+    max_dims = max(ann.bbox_dims().max() for ann in annotations)
+    if side_length is None:
+        side_length = np.ceil(max_dims)
+    else:
+        if not isinstance(side_length, int):
+            raise TypeError('`side_length` must be an integer.')
+        if side_length < max_dims:
+            raise ValueError('`side_length` must be greater\
+                               than any bounding box dimension.')
+    side_length = float(side_length)
+    # } End input checks.
+
+    if resample_vol and volume is None:
+        volume = scan.to_volume(verbose=verbose, mmap=True)
+
+    # The grids on which the scan is sampled.
+    zs = scan_slice_zvals(scan)
+    grids = [np.arange(512)*scan.pixel_spacing,
+             np.arange(512)*scan.pixel_spacing, zs]
+
+    m = int(side_length) + 1
+    masks = np.zeros((n, m, m, m), dtype=bool)
+    if resample_vol:
+        ct_volumes = np.empty((n, m, m, m), dtype=np.float32)
+        fillval = np.float32(volume.min())
+    irp_pts = []
+
+    for a,ann in enumerate(annotations):
+        axes = cubic_grid(ann, side_length, zs)
+        weights = [_linear_weights(g, p) for g,p in zip(grids, axes)]
+        irp_pts.append(axes)
+
+        # Only the region of the scan around the cube is read.
+        lo = [w[0].min() for w in weights]
+        hi = [w[0].max() + 2 for w in weights]
+        region = tuple(slice(l, h) for l,h in zip(lo, hi))
+        local = [w[0] - l for w,l in zip(weights, lo)]
+
+        inside = weights[0][2][:,None,None] & \
+                 weights[1][2][None,:,None] & \
+                 weights[2][2][None,None,:]
+
+        # Place the mask of the annotation in the region.
+        bbox = ann.bbox_matrix()
+        mask = np.zeros([h-l for l,h in zip(lo, hi)], dtype=bool)
+        src, dst = [], []
+        for axis in range(3):
+            start = max(bbox[axis,0], lo[axis])
+            stop  = min(bbox[axis,1]+1, hi[axis])
+            src.append(slice(start - bbox[axis,0], stop - bbox[axis,0]))
+            dst.append(slice(start - lo[axis], stop - lo[axis]))
+        mask[tuple(dst)] = ann.boolean_mask(bbox=bbox)[tuple(src)]
+
+        for axis in range(3):
+            mask = _dilate_axis(mask, local[axis], weights[axis][1], axis)
+        masks[a] = mask & inside
+
+        if resample_vol:
+            values = np.asarray(volume[region], dtype=np.float32)
+            for axis in range(3):
+                values = _interpolate_axis(values, local[axis],
+                                           weights[axis][1], axis)
+            ct_volumes[a] = np.where(inside, values, fillval)
+
+    result = (ct_volumes, masks) if resample_vol else (masks,)
+    if return_irp_pts:
+        result += (irp_pts,)
+    return result if len(result) > 1 else result[0]
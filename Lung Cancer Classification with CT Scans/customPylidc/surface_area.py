@@ -0,0 +1,120 @@
+"""
+Surface area estimates of annotation masks. Both methods work on the
+boolean mask directly: the marching cubes mesh is built from a padded
+uint8 copy of it (skimage only converts it to float32) instead of a
+float64 one, and the face counting approximation does not build a mesh
+at all.
+
+The `spacing` of a mask is its (i,j,k) voxel size in mm. As in
+`Annotation.surface_area`, the scan's `slice_thickness` is used along k
+(unlike `Annotation.volume`, which uses the contour spacing).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from skimage.measure import mesh_surface_area
+
+try:
+    from skimage.measure import marching_cubes
+except ImportError:
+    # Old version compatible since marching_cubes replaced with marchin_cubes_lewiner in skimage 0.19.0
+    from skimage.measure import marching_cubes_lewiner as marching_cubes
+
+
+methods = ('marching_cubes', 'faces')
+
+
+def marching_cubes_area(mask, spacing):
+    """
+    The area of the marching cubes mesh of the 0.5 level set of the
+    mask, padded with zeros to cap its ends.
+    """
+    padded = np.pad(mask.view(np.uint8) if mask.dtype == bool else mask,
+                    1, 'constant')
+    verts, faces, _, _ = marching_cubes(padded, 0.5, spacing=tuple(spacing))
+    return mesh_surface_area(verts, faces)
+
+
+def face_count_area(mask, spacing):
+    """
+    The total area of the voxel faces that separate the mask from its
+    complement (the outside of the mask included). This overestimates
+    the area of smooth surfaces, by about 50% for a sphere, but costs a
+    few passes over the mask.
+    """
+    padded = np.pad(mask.view(np.uint8) if mask.dtype == bool else mask,
+                    1, 'constant').astype(bool)
+    ri, rj, rk = spacing
+    faces = [np.count_nonzero(padded[1:] != padded[:-1]),
+             np.count_nonzero(padded[:,1:] != padded[:,:-1]),
+             np.count_nonzero(padded[:,:,1:] != padded[:,:,:-1])]
+    return faces[0]*rj*rk + faces[1]*ri*rk + faces[2]*ri*rj
+
+
+def mask_surface_area(mask, spacing, method='marching_cubes'):
+    """
+    Estimate the surface area of a boolean mask in mm^2.
+
+    Parameters
+    ----------
+    mask: ndarray, shape=(ni,nj,nk)
+        A bool or uint8 mask.
+
+    spacing: tuple of floats
+        The (i,j,k) voxel size in mm.
+
+    method: str, default='marching_cubes'
+        One of `methods`: the area of the marching cubes mesh (as
+        `Annotation.surface_area`) or the voxel face counting
+        approximation.
+    """
+    if method == 'marching_cubes':
+        return marching_cubes_area(mask, spacing)
+    elif method == 'faces':
+        return face_count_area(mask, spacing)
+    else:
+        raise ValueError("Invalid method: %s. Available methods are: %s"
+                         % (method, list(methods)))
+
+
+def annotation_surface_areas(annotations, method='marching_cubes',
+                             n_workers=None):
+    """
+    Estimate the surface area of each annotation in mm^2, see
+    `mask_surface_area`.
+
+    The bounding boxes and spacings are read in the calling thread, since
+    they query the database, while the masks and their areas are
+    computed over a thread pool.
+
+    Parameters
+    ----------
+    annotations: list of pylidc.Annotation
+
+    method: str, default='marching_cubes'
+        See `mask_surface_area`.
+
+    n_workers: int, default=None
+        The number of threads. If None, the default of
+        `concurrent.futures.ThreadPoolExecutor` is used.
+
+    Return
+    ------
+    areas: ndarray, shape=(len(annotations),)
+    """
+    if method not in methods:
+        raise ValueError("Invalid method: %s. Available methods are: %s"
+                         % (method, list(methods)))
+
+    jobs = []
+    for ann in annotations:
+        rij = ann.scan.pixel_spacing
+        rk  = ann.scan.slice_thickness
+        jobs.append((ann, ann.bbox_matrix(), (rij, rij, rk)))
+
+    def area(job):
+        ann, bbox, spacing = job
+        return mask_surface_area(ann.boolean_mask(bbox=bbox), spacing, method)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return np.array(list(pool.map(area, jobs)), dtype=np.float64)
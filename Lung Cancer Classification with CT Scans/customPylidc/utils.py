@@ -51,9 +51,23 @@ def consensus(anns, clevel=0.5, pad=None, ret_masks=True):
     cbbox = np.array([[imin,imax],
                       [jmin,jmax],
                       [kmin,kmax]])
-
-    masks = [a.boolean_mask(bbox=cbbox) for a in anns]
-    cmask = np.mean(masks, axis=0) >= clevel
+    shape = tuple(np.diff(cbbox, axis=1).astype(int)[:,0] + 1)
+
+    # Each annotation is rasterized on its own (unpadded) bounding box,
+    # from its cached contour fills, and added into the voxel counts.
+    counts = np.zeros(shape, dtype=np.min_scalar_type(len(anns)))
+    masks = []
+    for a in anns:
+        bb = a.bbox_matrix()
+        region = tuple(slice(lo, hi+1) for lo,hi in bb - cbbox[:,:1])
+        mask = a.boolean_mask(bbox=bb)
+        counts[region] += mask
+        if ret_masks:
+            full = np.zeros(shape, dtype=bool)
+            full[region] = mask
+            masks.append(full)
+
+    cmask = counts >= consensus_count(len(anns), clevel)
     cbbox = tuple(slice(cb[0], cb[1]+1, None) for cb in cbbox)
 
     if ret_masks:
@@ -61,6 +75,42 @@ def consensus(anns, clevel=0.5, pad=None, ret_masks=True):
     else:
         return cmask, cbbox
 
+def consensus_count(n, clevel=0.5):
+    """
+    The least number of the `n` annotations that must include a voxel
+    for it to be in the consensus mask, i.e., the least `c` for which
+    `c/n >= clevel` (evaluated in floating point, as the mean of the
+    masks would be). Returns `n+1` if no count reaches `clevel`.
+    """
+    reached = np.flatnonzero(np.arange(n+1) / n >= clevel)
+    return reached[0] if len(reached) else n+1
+
+def scan_consensus(scan, clevel=0.5, pad=None, ret_masks=False,
+                   **cluster_kwargs):
+    """Return the consensus volume of each nodule of a scan, i.e.,
+    `consensus` applied to each cluster of `Scan.cluster_annotations`.
+
+    The masks are accumulated one annotation at a time, so the memory
+    used is bounded by the largest nodule rather than the scan.
+
+    Parameters
+    ----------
+    scan: `pylidc.Scan` object
+
+    clevel, pad, ret_masks:
+        See `consensus`. Note that `ret_masks` defaults to False here.
+
+    cluster_kwargs:
+        Passed to `Scan.cluster_annotations`.
+
+    Returns
+    -------
+    consensi: list of tuples
+        `consensi[i]` is the output of `consensus` for the i-th cluster.
+    """
+    return [consensus(anns, clevel=clevel, pad=pad, ret_masks=ret_masks)
+            for anns in scan.cluster_annotations(**cluster_kwargs)]
+
 def volume_viewer(vol, mask=None, axis=2, aspect=None, **line_kwargs):
     """
     Interactive volume viewer utility
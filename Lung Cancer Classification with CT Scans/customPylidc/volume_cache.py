@@ -0,0 +1,130 @@
+"""
+An on-disk cache of CT volumes. Each series is stored as a raw int16
+`.npy` file, named after its series instance uid, alongside a JSON file
+with its metadata (shape, spacings, slice z values and the modification
+time of the DICOM directory it was built from). Cached volumes are
+returned as read-only memory maps, so repeated loads cost no decoding
+and only the pages that are actually accessed are read.
+"""
+import os
+import json
+import tempfile
+
+import numpy as np
+
+
+class VolumeCache(object):
+    """
+    Parameters
+    ----------
+    directory: string
+        The directory holding the cached volumes. It is created on the
+        first call to `store` if it does not exist.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _paths(self, series_instance_uid):
+        base = os.path.join(self.directory, series_instance_uid)
+        return base + '.npy', base + '.json'
+
+    def load_metadata(self, series_instance_uid):
+        """
+        Return the metadata dictionary of a cached volume, or None if the
+        volume is not cached.
+        """
+        npy, meta = self._paths(series_instance_uid)
+        if not (os.path.exists(npy) and os.path.exists(meta)):
+            return None
+        try:
+            with open(meta, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def load(self, series_instance_uid, source_mtime=None):
+        """
+        Return the cached volume as a read-only `np.memmap`, or None if
+        the volume is not cached or is out of date, i.e., if `source_mtime`
+        is given and differs from the one recorded when it was built.
+        """
+        metadata = self.load_metadata(series_instance_uid)
+        if metadata is None:
+            return None
+        if source_mtime is not None and \
+           metadata['source_mtime'] != source_mtime:
+            return None
+
+        npy, _ = self._paths(series_instance_uid)
+        volume = np.load(npy, mmap_mode='r')
+        if list(volume.shape) != metadata['shape'] or \
+           volume.dtype != np.int16:
+            return None
+        return volume
+
+    def store(self, series_instance_uid, images, metadata):
+        """
+        Write the volume of the (sorted) DICOM `images` straight into a
+        preallocated, memory-mapped int16 array, one slice at a time, and
+        record its `metadata`. The rescaled values of each slice are
+        truncated to int16, as in `Scan.to_volume`.
+
+        Return
+        ------
+        volume: np.memmap
+            The cached volume, opened read-only.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        npy, meta = self._paths(series_instance_uid)
+        shape = images[0].pixel_array.shape + (len(images),)
+
+        # Build under unique temporary names (so that concurrent stores of
+        # the same series, from other threads or processes, never share
+        # one), then move the files into place so that a partially written
+        # volume is never loaded.
+        tmp = _temporary_file(self.directory, npy)
+        try:
+            volume = np.lib.format.open_memmap(tmp, mode='w+',
+                                               dtype=np.int16, shape=shape)
+            fill_volume(volume, images)
+            volume.flush()
+            del volume
+            os.replace(tmp, npy)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        metadata = dict(metadata, shape=list(shape), dtype='int16')
+        tmp = _temporary_file(self.directory, meta)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(tmp, meta)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        return np.load(npy, mmap_mode='r')
+
+
+def _temporary_file(directory, filename):
+    """
+    Create an empty, uniquely named temporary file next to `filename`
+    and return its path.
+    """
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False,
+                                     prefix=os.path.basename(filename) + '.',
+                                     suffix='.tmp') as f:
+        return f.name
+
+
+def fill_volume(volume, images):
+    """
+    Write the rescaled pixel data of each image into the corresponding
+    slice (last axis) of the preallocated int16 `volume`.
+    """
+    for k,image in enumerate(images):
+        volume[:,:,k] = image.pixel_array * image.RescaleSlope + \
+                        image.RescaleIntercept
+    return volume